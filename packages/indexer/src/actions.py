@@ -33,6 +33,43 @@ def index_elastic_document(index_name, document):
         print(e)
 
 
+def index_elastic_documents(index_name, documents, refresh=False):
+    # failures are raised, so the documents are not recorded as indexed
+    r = requests.post(
+        INDEXER_BASE_URL
+        + "/elastic/index/{index_name}/docs:bulk".replace("{index_name}", index_name),
+        json={"docs": documents, "refresh": refresh},
+    )
+    r.raise_for_status()
+    return r.json()
+
+
+def start_elastic_load(index_name):
+    try:
+        r = requests.post(
+            INDEXER_BASE_URL
+            + "/elastic/index/{index_name}/load:start".replace(
+                "{index_name}", index_name
+            )
+        )
+        return r.json()
+    except HTTPError as e:
+        print(e)
+
+
+def end_elastic_load(index_name):
+    try:
+        r = requests.post(
+            INDEXER_BASE_URL
+            + "/elastic/index/{index_name}/load:end".replace(
+                "{index_name}", index_name
+            )
+        )
+        return r.json()
+    except HTTPError as e:
+        print(e)
+
+
 def delete_elastic_index(name):
     try:
         r = requests.delete(
@@ -89,28 +126,59 @@ def count_chroma_collection_docs(collection_name):
 
 
 def index_chroma_document(collection_name, document):
-    return requests.post(
+    # failures are raised, so the documents are not recorded as indexed
+    r = requests.post(
         INDEXER_BASE_URL
         + "/chroma/collection/{collection_name}/doc".replace(
             "{collection_name}", collection_name
         ),
         json=document,
     )
+    r.raise_for_status()
+    return r
 
 
-def delete_chroma_document(collection_name, document_id):
+def index_chroma_documents(collection_name, documents):
     try:
-        r = requests.delete(
+        r = requests.post(
             INDEXER_BASE_URL
-            + "/chroma/collection/{collection_name}/doc/{document_id}".replace(
+            + "/chroma/collection/{collection_name}/docs".replace(
                 "{collection_name}", collection_name
-            ).replace("{document_id}", document_id)
+            ),
+            json={"documents": documents},
         )
         return r.json()
     except HTTPError as e:
         print(e)
 
 
+def get_existing_chroma_ids(collection_name, ids):
+    try:
+        r = requests.post(
+            INDEXER_BASE_URL
+            + "/chroma/collection/{collection_name}/ids:exists".replace(
+                "{collection_name}", collection_name
+            ),
+            json={"ids": ids},
+        )
+        r.raise_for_status()
+        return r.json()["ids"]
+    except HTTPError as e:
+        print(e)
+
+
+def delete_chroma_document(collection_name, document_id):
+    # failures are raised, so stale chunks are not left behind silently
+    r = requests.delete(
+        INDEXER_BASE_URL
+        + "/chroma/collection/{collection_name}/doc/{document_id}".replace(
+            "{collection_name}", collection_name
+        ).replace("{document_id}", document_id)
+    )
+    r.raise_for_status()
+    return r.json()
+
+
 def query_chroma(collection_name, options):
     try:
         r = requests.post(
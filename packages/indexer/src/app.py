@@ -1,18 +1,34 @@
-from elasticsearch import Elasticsearch
+from elasticsearch import Elasticsearch, AsyncElasticsearch, NotFoundError
+from elasticsearch.helpers import streaming_bulk
 import uvicorn
-from pydantic import BaseModel
+from pydantic import BaseModel, root_validator
 from typing import List
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import FastAPI, HTTPException, Depends
-import chromadb
 from chromadb import errors
-from chromadb.config import Settings
-import uuid
-from sentence_transformers import SentenceTransformer
-from functools import lru_cache
+from functools import lru_cache, partial
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import base64
+import json
 from settings import AppSettings
-from retriever import DocumentRetriever
-from utils import get_facets_annotations, get_facets_metadata, get_hits
+from retriever import CachedDocumentRetriever
+from chunker import create_chunker
+from embedding_cache import QueryEmbeddingCache, ChunkEmbeddingCache
+from embedding import encode_batched, load_embedding_model
+from batcher import EmbeddingBatcher
+from utils import (
+    get_facets_annotations,
+    get_facets_metadata,
+    get_facets_aggs,
+    get_chunk_ids,
+    encode_embeddings,
+    decode_embeddings,
+    get_hits,
+    reciprocal_rank_fusion,
+)
+from cache import LRUCache
+from vector_store import create_vector_store, IDAlreadyExistsError
 import torch
 
 
@@ -34,10 +50,29 @@ app.add_middleware(
 )
 
 
+async def run_io(fn, *args, **kwargs):
+    # run blocking client calls on the io thread pool, not on the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(io_executor, partial(fn, *args, **kwargs))
+
+
+@app.on_event("startup")
+async def startup():
+    embedding_batcher.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await embedding_batcher.stop()
+    await es_async_client.close()
+    await retriever.aclose()
+    query_embedding_cache.close()
+
+
 @app.get("/chroma/collection/{collection_name}")
 def get_collection(collection_name):
     try:
-        return chroma_client.get_collection(name=collection_name)
+        return vector_store.get_collection(collection_name).dict()
     except Exception:
         raise HTTPException(status_code=404049, detail="Collection not found")
 
@@ -49,7 +84,7 @@ class CreateCollectionRequest(BaseModel):
 @app.post("/chroma/collection")
 def create_collection(req: CreateCollectionRequest):
     # try:
-    collection = chroma_client.get_or_create_collection(name=req.name)
+    collection = vector_store.get_or_create_collection(name=req.name)
     count = collection.count()
 
     return {**collection.dict(), "n_documents": count}
@@ -60,7 +95,7 @@ def create_collection(req: CreateCollectionRequest):
 @app.get("/chroma/collection/{collection_name}/count")
 def count_collection_docs(collection_name):
     try:
-        collection = chroma_client.get_collection(collection_name)
+        collection = vector_store.get_collection(collection_name)
         count = collection.count()
 
         return {"total_docs": count}
@@ -74,45 +109,181 @@ def count_collection_docs(collection_name):
 @app.delete("/chroma/collection/{collection_name}")
 def delete_collection(collection_name):
     try:
-        chroma_client.delete_collection(name=collection_name)
+        vector_store.delete_collection(name=collection_name)
         return {"count": 1}
     except ValueError as e:
         raise HTTPException(status_code=404, detail="Collection not found")
 
 
 class IndexDocumentRequest(BaseModel):
-    embeddings: List[List[float]]
+    embeddings: List[List[float]] = None
+    # the same embeddings as base64 of little endian float32 rows, much
+    # smaller than json and decoded without parsing floats
+    embeddings_b64: str = None
     documents: List[str]
     metadatas: List[dict] = []
+    # derived from doc_id, chunk index and chunk text when not given
+    ids: List[str] = None
+    # replace chunks with the same id instead of failing
+    upsert: bool = True
+
+    @root_validator(skip_on_failure=True)
+    def check_embeddings(cls, values):
+        # without embeddings chroma would embed the chunks with its own model,
+        # in another space than the queries
+        embeddings, embeddings_b64 = values["embeddings"], values["embeddings_b64"]
+        if (embeddings is None) == (embeddings_b64 is None):
+            raise ValueError("Exactly one of embeddings and embeddings_b64 is needed")
+        if embeddings is not None and len(embeddings) != len(values["documents"]):
+            raise ValueError("There must be one embedding per document")
+        return values
 
 
 @app.post("/chroma/collection/{collection_name}/doc")
 def index_chroma_document(req: IndexDocumentRequest, collection_name):
+    embeddings = req.embeddings
+    if req.embeddings_b64 is not None:
+        try:
+            embeddings = decode_embeddings(req.embeddings_b64, len(req.documents))
+        except ValueError as e:
+            raise HTTPException(
+                status_code=400, detail="Invalid embeddings_b64: " + str(e)
+            )
+        # the chroma client only takes lists, the flat store takes the array
+        if not vector_store.accepts_arrays:
+            embeddings = embeddings.tolist()
+
     try:
-        collection = chroma_client.get_collection(collection_name)
-        chunks_ids = [str(uuid.uuid4()) for _ in req.embeddings]
+        collection = vector_store.get_collection(collection_name)
+        if len(req.documents) == 0:
+            return {"added": 0}
 
-        collection.add(
+        chunks_ids = req.ids or get_chunk_ids(req.documents, req.metadatas)
+
+        write = collection.upsert if req.upsert else collection.add
+        write(
             documents=req.documents,
-            embeddings=req.embeddings,
-            metadatas=req.metadatas,
+            embeddings=embeddings,
+            metadatas=req.metadatas or None,
             ids=chunks_ids,
         )
 
-        return {"added": len(req.embeddings)}
-    except errors.IDAlreadyExistsError:
+        return {"added": len(req.documents)}
+    except (errors.IDAlreadyExistsError, IDAlreadyExistsError):
         raise HTTPException(
             status_code=409, detail="A document with the same id already exists"
         )
     except Exception as e:
-        raise HTTPException(status_code=500, detail=req.embeddings)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+class BulkDocument(BaseModel):
+    text: str
+    metadata: dict = {}
+
+
+class IndexDocumentsBulkRequest(BaseModel):
+    documents: List[BulkDocument]
+    # do not embed chunks whose id is already in the collection
+    skip_existing: bool = True
+
+
+@app.post("/chroma/collection/{collection_name}/docs")
+def index_chroma_documents(req: IndexDocumentsBulkRequest, collection_name):
+    try:
+        collection = vector_store.get_collection(collection_name)
+    except Exception:
+        raise HTTPException(status_code=404, detail="Collection not found")
+
+    # chunk every document and remember which document each chunk belongs to
+    chunks = []
+    metadatas = []
+    chunk_doc_index = []
+    docs_chunks = chunker.chunk_many([doc.text for doc in req.documents])
+    for doc_index, (doc, doc_chunks) in enumerate(zip(req.documents, docs_chunks)):
+        chunks.extend(doc_chunks)
+        metadatas.extend([doc.metadata for _ in doc_chunks])
+        chunk_doc_index.extend([doc_index for _ in doc_chunks])
+
+    statuses = [
+        {"index": i, "status": "ok", "added": 0, "skipped": 0}
+        for i in range(len(req.documents))
+    ]
+
+    chunks_ids = get_chunk_ids(chunks, metadatas)
+    if req.skip_existing and len(chunks_ids) > 0:
+        existing = set(get_existing_ids(collection, chunks_ids))
+        keep = [i for i, id in enumerate(chunks_ids) if id not in existing]
+        for i, id in enumerate(chunks_ids):
+            if id in existing:
+                statuses[chunk_doc_index[i]]["skipped"] += 1
+
+        chunks = [chunks[i] for i in keep]
+        metadatas = [metadatas[i] for i in keep]
+        chunk_doc_index = [chunk_doc_index[i] for i in keep]
+        chunks_ids = [chunks_ids[i] for i in keep]
+
+    if len(chunks) == 0:
+        return {"added": 0, "documents": statuses}
+
+    # embed the chunks of all documents in batches of similar token length
+    embeddings = encode_batched(
+        model, chunks, settings.embedding_token_budget, cache=chunk_embedding_cache
+    )
+    embeddings = embeddings.tolist()
+
+    added = 0
+    batch_size = settings.chroma_add_batch_size
+    for start in range(0, len(chunks), batch_size):
+        end = start + batch_size
+        batch_doc_index = chunk_doc_index[start:end]
+
+        try:
+            collection.upsert(
+                documents=chunks[start:end],
+                embeddings=embeddings[start:end],
+                metadatas=metadatas[start:end],
+                ids=chunks_ids[start:end],
+            )
+        except Exception as e:
+            # mark every document with chunks in the failed batch
+            for doc_index in set(batch_doc_index):
+                statuses[doc_index]["status"] = "error"
+                statuses[doc_index]["detail"] = str(e)
+            continue
+
+        added += len(batch_doc_index)
+        for doc_index in batch_doc_index:
+            statuses[doc_index]["added"] += 1
+
+    del embeddings
+
+    return {"added": added, "documents": statuses}
+
+
+def get_existing_ids(collection, ids: list):
+    return collection.get(ids=ids, include=[])["ids"]
+
+
+class ExistingIdsRequest(BaseModel):
+    ids: List[str]
+
+
+@app.post("/chroma/collection/{collection_name}/ids:exists")
+def get_existing_chunk_ids(req: ExistingIdsRequest, collection_name):
+    try:
+        collection = vector_store.get_collection(collection_name)
+    except Exception:
+        raise HTTPException(status_code=404, detail="Collection not found")
+
+    return {"ids": get_existing_ids(collection, req.ids)}
 
 
 @app.delete("/chroma/collection/{collection_name}/doc/{document_id}")
 def delete_document(collection_name, document_id):
     try:
         # delete indexed embeddings for the document
-        collection = chroma_client.get_collection(collection_name)
+        collection = vector_store.get_collection(collection_name)
         collection.delete(where={"doc_id": document_id})
         return {"count": 1}
 
@@ -127,25 +298,55 @@ class QueryCollectionRquest(BaseModel):
     k: int = 5
     where: dict = None
     include: List[str] = ["metadatas", "documents", "distances"]
-
-
-@app.post("/chroma/collection/{collection_name}/query")
-async def query_collection(collection_name: str, req: QueryCollectionRquest):
-    # try:
-    # get most similar chunks
-    collection = chroma_client.get_collection(collection_name)
-    embeddings = []
-
-    with torch.no_grad():
-        # create embeddings for the query
-        embeddings = model.encode(req.query)
-    embeddings = embeddings.tolist()
-
-    result = collection.query(
+    # precomputed query embedding, base64 of little endian float32
+    query_embedding_b64: str = None
+    # format of the chunk embeddings returned when included: "json" or "b64"
+    embeddings_format: str = "json"
+    # where full documents are fetched from: "documents" service or "elastic"
+    hydrate_from: str = "documents"
+    # elastic index used when hydrating from elastic, defaults to the collection name
+    elastic_index: str = None
+
+
+async def embed_query(text: str):
+    embeddings = query_embedding_cache.get(text)
+    if embeddings is None and query_embedding_cache.persistent():
+        # the disk tier is sqlite, it is read on the io pool, not on the loop
+        embeddings = await run_io(query_embedding_cache.get_stored, text)
+
+    if embeddings is None:
+        # create embeddings for the query, batched with concurrent queries
+        embeddings = await embedding_batcher.embed(text)
+        query_embedding_cache.set(text, embeddings)
+        if query_embedding_cache.persistent():
+            # written in the background, the response does not wait for it
+            io_executor.submit(query_embedding_cache.store, text, embeddings)
+
+    return embeddings.tolist()
+
+
+async def search_chunks(
+    collection_name: str,
+    query: str,
+    k: int,
+    where,
+    include,
+    query_embedding_b64: str = None,
+    embeddings_format: str = "json",
+):
+    # get most similar chunks, grouped by document in order of best chunk
+    collection = await run_io(vector_store.get_collection, collection_name)
+    if query_embedding_b64 is not None:
+        embeddings = decode_embeddings(query_embedding_b64, 1)[0].tolist()
+    else:
+        embeddings = await embed_query(query)
+
+    result = await run_io(
+        collection.query,
         query_embeddings=embeddings,
-        n_results=req.k,
-        where=req.where,
-        include=req.include,
+        n_results=k,
+        where=where,
+        include=include,
     )
 
     del embeddings
@@ -159,36 +360,164 @@ async def query_collection(collection_name: str, req: QueryCollectionRquest):
             "metadata": metadata,
             "text": result["documents"][0][index],
         }
+        if "embeddings" in include:
+            embedding = result["embeddings"][0][index]
+            if embeddings_format == "b64":
+                embedding = encode_embeddings(embedding)
+            chunk["embedding"] = embedding
 
         if metadata["doc_id"] in doc_chunk_ids_map:
             doc_chunk_ids_map[metadata["doc_id"]].append(chunk)
         else:
             doc_chunk_ids_map[metadata["doc_id"]] = [chunk]
 
-    # get full documents from db
+    return doc_chunk_ids_map
+
+
+@app.post("/chroma/collection/{collection_name}/query")
+async def query_collection(collection_name: str, req: QueryCollectionRquest):
+    doc_chunk_ids_map = await search_chunks(
+        collection_name,
+        req.query,
+        req.k,
+        req.where,
+        req.include,
+        query_embedding_b64=req.query_embedding_b64,
+        embeddings_format=req.embeddings_format,
+    )
+
+    # get full documents, concurrently
     doc_ids = list(doc_chunk_ids_map.keys())
 
-    full_docs = []
-    for doc_id in doc_ids:
-        d = retriever.retrieve(doc_id)
-        # d = requests.get(
-        #     "http://"
-        #     + settings.host_base_url
-        #     + ":"
-        #     + settings.docs_port
-        #     + "/api/mongo/document/"
-        #     + str(doc_id)
-        # ).json()
-        full_docs.append(d)
+    if req.hydrate_from == "elastic":
+        full_docs = await hydrate_from_elastic(
+            req.elastic_index or collection_name, doc_ids
+        )
+    else:
+        full_docs = await retriever.aretrieve_many(doc_ids)
 
     doc_results = []
 
-    for doc in full_docs:
-        doc_results.append({"doc": doc, "chunks": doc_chunk_ids_map[doc["id"]]})
+    for doc_id, doc in zip(doc_ids, full_docs):
+        if doc is None:
+            continue
+        doc_results.append({"doc": doc, "chunks": doc_chunk_ids_map[doc_id]})
 
     return doc_results
 
 
+async def hydrate_from_elastic(index_name: str, doc_ids: list):
+    # elastic documents are indexed with the mongo id as _id
+    res = await es_async_client.mget(
+        index=index_name, ids=[str(doc_id) for doc_id in doc_ids]
+    )
+
+    return [
+        {"id": doc["_source"]["mongo_id"], **doc["_source"]}
+        if doc["found"]
+        else None
+        for doc in res["docs"]
+    ]
+
+
+@app.get("/retriever/cache")
+def get_retriever_cache_stats():
+    return retriever.stats()
+
+
+@app.delete("/retriever/cache/{document_id}")
+def invalidate_retriever_cache(document_id):
+    return {"count": int(retriever.invalidate(document_id))}
+
+
+@app.get("/embeddings/cache")
+def get_query_embedding_cache_stats():
+    return query_embedding_cache.stats()
+
+
+@app.get("/elastic/facets/cache")
+def get_facets_cache_stats():
+    return facets_cache.stats()
+
+
+@app.get("/embeddings/chunks/cache")
+def get_chunk_embedding_cache_stats():
+    if chunk_embedding_cache is None:
+        return {}
+    return chunk_embedding_cache.stats()
+
+
+@app.get("/embeddings/batcher")
+def get_embedding_batcher_stats():
+    return embedding_batcher.stats()
+
+
+class HybridQueryRequest(BaseModel):
+    query: str
+    k: int = 10
+    # candidates retrieved from each backend before fusion
+    elastic_k: int = 50
+    dense_k: int = 50
+    elastic_weight: float = 1.0
+    dense_weight: float = 1.0
+    # rank constant of reciprocal rank fusion
+    rrf_k: int = 60
+    where: dict = None
+
+
+@app.post("/hybrid/{name}/query")
+async def hybrid_query(name: str, req: HybridQueryRequest):
+    # bm25 and dense searches run concurrently, name is both index and collection
+    elastic_res, doc_chunk_ids_map = await asyncio.gather(
+        es_async_client.search(
+            index=name,
+            size=req.elastic_k,
+            query={"match": {"text": req.query}},
+            source_excludes=["annotations"],
+        ),
+        search_chunks(
+            name,
+            req.query,
+            req.dense_k,
+            req.where,
+            ["metadatas", "documents", "distances"],
+        ),
+    )
+
+    elastic_hits = {str(hit["mongo_id"]): hit for hit in get_hits(elastic_res)}
+    elastic_scores = {
+        str(hit["_source"]["mongo_id"]): hit["_score"]
+        for hit in elastic_res["hits"]["hits"]
+    }
+    dense_chunks = {str(doc_id): chunks for doc_id, chunks in doc_chunk_ids_map.items()}
+
+    fused = reciprocal_rank_fusion(
+        {"elastic": list(elastic_hits.keys()), "dense": list(dense_chunks.keys())},
+        weights={"elastic": req.elastic_weight, "dense": req.dense_weight},
+        k=req.rrf_k,
+    )
+
+    results = []
+    for doc_id, score, ranks in fused[: req.k]:
+        chunks = dense_chunks.get(doc_id, [])
+        results.append(
+            {
+                "doc_id": doc_id,
+                "score": score,
+                "elastic": {"rank": ranks["elastic"], "score": elastic_scores[doc_id]}
+                if "elastic" in ranks
+                else None,
+                "dense": {"rank": ranks["dense"], "distance": chunks[0]["distance"]}
+                if "dense" in ranks
+                else None,
+                "hit": elastic_hits.get(doc_id),
+                "chunks": chunks,
+            }
+        )
+
+    return results
+
+
 class CreateElasticIndexRequest(BaseModel):
     name: str
 
@@ -233,6 +562,7 @@ def create_elastic_index(req: CreateElasticIndexRequest):
 def delete_elastic_index(index_name):
     try:
         es_client.indices.delete(index=index_name)
+        invalidate_facets(index_name)
         return {"count": 1}
     except Exception as e:
         print(e)
@@ -245,8 +575,15 @@ class IndexElasticDocumentRequest(BaseModel):
 
 @app.post("/elastic/index/{index_name}/doc")
 def index_elastic_document(req: IndexElasticDocumentRequest, index_name):
-    res = es_client.index(index=index_name, document=req.doc)
+    # use the mongo id as elastic id so documents can be fetched with mget
+    doc_id = req.doc.get("mongo_id")
+    res = es_client.index(
+        index=index_name,
+        id=str(doc_id) if doc_id is not None else None,
+        document=req.doc,
+    )
     es_client.indices.refresh(index=index_name)
+    invalidate_facets(index_name)
     return res["result"]
     # try:
     #     collection = chroma_client.get_collection(collection_name)
@@ -268,6 +605,121 @@ def index_elastic_document(req: IndexElasticDocumentRequest, index_name):
     #     raise HTTPException(status_code=500, detail=req.embeddings)
 
 
+class IndexElasticDocumentsBulkRequest(BaseModel):
+    docs: List[dict]
+    # make the documents searchable right away, avoid it during large imports
+    refresh: bool = False
+
+
+@app.post("/elastic/index/{index_name}/docs:bulk")
+def index_elastic_documents(req: IndexElasticDocumentsBulkRequest, index_name):
+    def to_action(doc):
+        action = {"_index": index_name, "_source": doc}
+        # use the mongo id as elastic id so documents can be fetched with mget
+        if doc.get("mongo_id") is not None:
+            action["_id"] = str(doc["mongo_id"])
+        return action
+
+    actions = (to_action(doc) for doc in req.docs)
+
+    indexed = 0
+    errors = []
+    # send documents in chunks bounded by number of documents and bytes
+    for i, (ok, item) in enumerate(
+        streaming_bulk(
+            es_client,
+            actions,
+            chunk_size=settings.elastic_bulk_chunk_size,
+            max_chunk_bytes=settings.elastic_bulk_max_chunk_bytes,
+            raise_on_error=False,
+            raise_on_exception=False,
+        )
+    ):
+        if ok:
+            indexed += 1
+        else:
+            errors.append({"index": i, "error": item["index"].get("error")})
+
+    if req.refresh:
+        es_client.indices.refresh(index=index_name)
+        invalidate_facets(index_name)
+    else:
+        # searchable after the next refresh, facets are not cached until then
+        invalidate_facets(index_name, refreshed=False)
+
+    return {"indexed": indexed, "failed": len(errors), "errors": errors}
+
+
+# index settings changed while a large import is running, restored at the end
+load_mode_settings = {}
+
+
+@app.post("/elastic/index/{index_name}/load:start")
+def start_elastic_load(index_name):
+    if index_name in load_mode_settings:
+        return {"load_mode": True}
+
+    index_settings = es_client.indices.get_settings(index=index_name)
+    index_settings = index_settings[index_name]["settings"]["index"]
+    load_mode_settings[index_name] = {
+        "refresh_interval": index_settings.get("refresh_interval", "1s"),
+        "number_of_replicas": index_settings.get("number_of_replicas", "1"),
+    }
+
+    # no periodic refresh and no replicas while loading documents
+    es_client.indices.put_settings(
+        index=index_name,
+        settings={"index": {"refresh_interval": "-1", "number_of_replicas": 0}},
+    )
+
+    return {"load_mode": True}
+
+
+@app.post("/elastic/index/{index_name}/load:end")
+def end_elastic_load(index_name):
+    if index_name not in load_mode_settings:
+        return {"load_mode": False}
+
+    es_client.indices.put_settings(
+        index=index_name,
+        settings={"index": load_mode_settings.pop(index_name)},
+    )
+    es_client.indices.refresh(index=index_name)
+    invalidate_facets(index_name)
+
+    return {"load_mode": False}
+
+
+# write generation of each index, bumped on writes to invalidate cached facets
+index_generations = {}
+# indexes with writes that are not searchable yet. Nothing would invalidate
+# facets cached before the periodic refresh lands, so they are not cached
+unrefreshed_indexes = set()
+
+
+def invalidate_facets(index_name: str, refreshed: bool = True):
+    index_generations[index_name] = index_generations.get(index_name, 0) + 1
+    if refreshed:
+        unrefreshed_indexes.discard(index_name)
+    else:
+        unrefreshed_indexes.add(index_name)
+
+
+def get_facets_cache_key(index_name: str, req):
+    # entries of older generations are never read again and age out of the lru
+    return json.dumps(
+        [
+            index_name,
+            index_generations.get(index_name, 0),
+            req.text,
+            req.annotations,
+            req.metadata,
+            req.n_facets,
+        ],
+        sort_keys=True,
+    )
+
+
 class QueryElasticIndexRequest(BaseModel):
     text: str
     metadata: list = None
@@ -275,6 +727,30 @@ class QueryElasticIndexRequest(BaseModel):
     n_facets: int = 20
     page: int = 1
     documents_per_page: int = 20
+    # cursor based pagination for deep pages, page is ignored when it is used
+    use_cursor: bool = False
+    cursor: str = None
+
+
+def encode_cursor(cursor: dict):
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode("utf-8")).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode("utf-8")))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # cursors are only made by encode_cursor, anything else is rejected here
+    if not (
+        isinstance(cursor, dict)
+        and isinstance(cursor.get("pit_id"), str)
+        and isinstance(cursor.get("page"), int)
+        # search_after is None on the first page of the pagination
+        and isinstance(cursor.get("search_after", False), (list, type(None)))
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return cursor
 
 
 @app.post("/elastic/index/{index_name}/query")
@@ -282,7 +758,34 @@ async def query_elastic_index(
     index_name: str,
     req: QueryElasticIndexRequest,
 ):
-    from_offset = (req.page - 1) * req.documents_per_page
+    cursor = None
+    if req.cursor is not None:
+        cursor = decode_cursor(req.cursor)
+    elif req.use_cursor:
+        # first page of a cursor pagination, keep a consistent view of the index
+        pit = await es_async_client.open_point_in_time(
+            index=index_name, keep_alive=settings.elastic_pit_keep_alive
+        )
+        cursor = {"pit_id": pit["id"], "search_after": None, "page": 1}
+
+    if cursor is None:
+        current_page = req.page
+        search_kwargs = {
+            "index": index_name,
+            "from_": (req.page - 1) * req.documents_per_page,
+        }
+    else:
+        current_page = cursor["page"]
+        search_kwargs = {
+            "pit": {
+                "id": cursor["pit_id"],
+                "keep_alive": settings.elastic_pit_keep_alive,
+            },
+            # _shard_doc is a stable tiebreaker between hits with the same score
+            "sort": [{"_score": "desc"}, {"_shard_doc": "asc"}],
+        }
+        if cursor["search_after"] is not None:
+            search_kwargs["search_after"] = cursor["search_after"]
 
     # build a query that retrieve conditions based AND conditions between text, annotation facets and metadata facets
     query = {
@@ -333,63 +836,65 @@ async def query_elastic_index(
                 },
             )
 
-    search_res = es_client.search(
-        index=index_name,
-        size=req.documents_per_page,
-        from_=from_offset,
-        query=query,
-        aggs={
-            "metadata": {
-                "nested": {"path": "metadata"},
-                "aggs": {
-                    "types": {
-                        "terms": {"field": "metadata.type", "size": req.n_facets},
-                        "aggs": {
-                            "values": {
-                                "terms": {
-                                    "field": "metadata.value",
-                                    "size": req.n_facets,
-                                    "order": {"_key": "asc"},
-                                }
-                            }
-                        },
-                    }
-                },
-            },
-            "annotations": {
-                "nested": {"path": "annotations"},
-                "aggs": {
-                    "types": {
-                        "terms": {"field": "annotations.type", "size": req.n_facets},
-                        "aggs": {
-                            "mentions": {
-                                "terms": {
-                                    "field": "annotations.id_ER",
-                                    "size": req.n_facets,
-                                },
-                                "aggs": {
-                                    "top_hits_per_mention": {
-                                        "top_hits": {
-                                            "_source": [
-                                                "annotations.display_name",
-                                                "annotations.is_linked",
-                                            ],
-                                            "size": 1,
-                                        }
-                                    }
-                                },
-                            }
-                        },
-                    }
+    # facets only depend on the query, not on the page, compute them once
+    facets_key = get_facets_cache_key(index_name, req)
+    cached_facets = facets_cache.get(facets_key)
+
+    try:
+        if cached_facets is None:
+            search_res = await es_async_client.search(
+                size=req.documents_per_page,
+                query=query,
+                aggs=get_facets_aggs(req.n_facets),
+                **search_kwargs,
+            )
+
+            cached_facets = {
+                "facets": {
+                    "annotations": get_facets_annotations(search_res),
+                    "metadata": get_facets_metadata(search_res),
                 },
-            },
-        },
-    )
+                "total_hits": search_res["hits"]["total"]["value"],
+            }
+            if index_name not in unrefreshed_indexes:
+                facets_cache.set(
+                    facets_key,
+                    cached_facets,
+                    len(json.dumps(cached_facets).encode("utf-8")),
+                )
+        else:
+            # hits only search, the total is already known
+            search_res = await es_async_client.search(
+                size=req.documents_per_page,
+                query=query,
+                track_total_hits=False,
+                **search_kwargs,
+            )
+    except NotFoundError:
+        if req.cursor is None:
+            raise
+        # the point in time of the cursor expired or was closed
+        raise HTTPException(
+            status_code=410, detail="Cursor expired, restart the pagination"
+        )
+
+    next_cursor = None
+    if cursor is not None:
+        raw_hits = search_res["hits"]["hits"]
+        if len(raw_hits) == req.documents_per_page:
+            next_cursor = encode_cursor(
+                {
+                    "pit_id": search_res["pit_id"],
+                    "search_after": raw_hits[-1]["sort"],
+                    "page": current_page + 1,
+                }
+            )
+        else:
+            # last page, release the point in time
+            await es_async_client.close_point_in_time(id=search_res["pit_id"])
 
     hits = get_hits(search_res)
-    annotations_facets = get_facets_annotations(search_res)
-    metadata_facets = get_facets_metadata(search_res)
-    total_hits = search_res["hits"]["total"]["value"]
+    total_hits = cached_facets["total_hits"]
     num_pages = total_hits // req.documents_per_page
     if (
         total_hits % req.documents_per_page > 0
@@ -398,11 +903,12 @@ async def query_elastic_index(
 
     return {
         "hits": hits,
-        "facets": {"annotations": annotations_facets, "metadata": metadata_facets},
+        "facets": cached_facets["facets"],
         "pagination": {
-            "current_page": req.page,
+            "current_page": current_page,
             "total_pages": num_pages,
             "total_hits": total_hits,
+            "cursor": next_cursor,
         },
     }
 
@@ -410,25 +916,81 @@ async def query_elastic_index(
 if __name__ == "__main__":
     settings = get_settings()
 
-    model = SentenceTransformer(settings.embedding_model, device="cuda")
+    # blocking chromadb calls run here, model inference has its own executor
+    io_executor = ThreadPoolExecutor(max_workers=settings.io_thread_pool_size)
+    model_executor = ThreadPoolExecutor(max_workers=settings.model_thread_pool_size)
 
-    model = model.to("cuda")
-    model = model.eval()
+    model = load_embedding_model(
+        settings.embedding_model,
+        device=settings.embedding_device,
+        quantize=settings.embedding_quantize,
+        num_threads=settings.embedding_num_threads,
+    )
 
-    chroma_client = chromadb.Client(
-        Settings(
-            chroma_api_impl="rest",
-            chroma_server_host=settings.host_base_url,
-            chroma_server_http_port=settings.chroma_port,
-        )
+    def encode_queries(texts):
+        with torch.no_grad():
+            return model.encode(texts, batch_size=len(texts))
+
+    embedding_batcher = EmbeddingBatcher(
+        encode_queries,
+        max_batch_size=settings.query_batch_max_size,
+        max_wait=settings.query_batch_max_wait_ms / 1000,
+        executor=model_executor,
+    )
+
+    # quantized models produce different vectors, they get their own cache
+    embedding_model_key = settings.embedding_model + (
+        "+int8" if settings.embedding_quantize else ""
+    )
+    chunk_embedding_cache = (
+        ChunkEmbeddingCache(settings.embedding_cache_dir, embedding_model_key)
+        if settings.embedding_cache_dir
+        else None
+    )
+
+    query_embedding_cache = QueryEmbeddingCache(
+        model_name=embedding_model_key,
+        max_bytes=settings.query_embedding_cache_max_bytes,
+        path=settings.query_embedding_cache_path,
+    )
+
+    facets_cache = LRUCache(
+        max_bytes=settings.facets_cache_max_bytes, ttl=settings.facets_cache_ttl
+    )
+
+    chunker = create_chunker(
+        settings.chunk_mode,
+        chunk_size=settings.chunk_size,
+        chunk_overlap=settings.chunk_overlap,
+        model=model,
+        max_tokens=settings.chunk_max_tokens,
+        chunk_overlap_tokens=settings.chunk_overlap_tokens,
+    )
+
+    vector_store = create_vector_store(
+        settings.vector_store,
+        host=settings.host_base_url,
+        port=settings.chroma_port,
+        directory=settings.vector_store_dir,
     )
     es_client = Elasticsearch(
         hosts=[{"host": "es", "scheme": "http", "port": int(settings.elastic_port)}],
         request_timeout=60,
     )
+    es_async_client = AsyncElasticsearch(
+        hosts=[{"host": "es", "scheme": "http", "port": int(settings.elastic_port)}],
+        request_timeout=60,
+    )
 
     DOCS_BASE_URL = "http://" + settings.host_base_url + ":" + settings.docs_port
-    retriever = DocumentRetriever(url=DOCS_BASE_URL + "/api/mongo/document")
+    retriever = CachedDocumentRetriever(
+        url=DOCS_BASE_URL + "/api/mongo/document",
+        max_concurrency=settings.retriever_max_concurrency,
+        timeout=settings.retriever_timeout,
+        cache_max_bytes=settings.retriever_cache_max_bytes,
+        cache_ttl=settings.retriever_cache_ttl,
+        coalesce=settings.retriever_cache_coalesce,
+    )
 
     # [start fastapi]:
     _PORT = int(settings.indexer_server_port)
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+
+class Histogram:
+    def __init__(self, buckets: list):
+        # upper bounds of the buckets, values above the last one go in "+Inf"
+        self.buckets = buckets
+        self.counts = [0 for _ in buckets] + [0]
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def dict(self):
+        return {
+            "buckets": {
+                **{str(b): c for b, c in zip(self.buckets, self.counts)},
+                "+Inf": self.counts[-1],
+            },
+            "count": self.count,
+            "mean": self.sum / self.count if self.count > 0 else 0,
+        }
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self, encode, max_batch_size: int = 32, max_wait: float = 0.005, executor=None
+    ):
+        # encode receives a list of texts and returns one embedding per text
+        self.encode = encode
+        self.max_batch_size = max_batch_size
+        # seconds to wait for more texts after the first one of a batch arrives
+        self.max_wait = max_wait
+        self.executor = executor
+
+        self.queue = None
+        self.worker = None
+
+        buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+        self.batch_sizes = Histogram(buckets)
+        self.queue_depths = Histogram(buckets)
+        self.wait_times_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500])
+
+    def start(self):
+        # must be called from the running event loop
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.get_running_loop().create_task(self.__run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+
+    async def embed(self, text: str):
+        future = asyncio.get_running_loop().create_future()
+        self.queue_depths.observe(self.queue.qsize())
+        await self.queue.put((text, future, time.monotonic()))
+        return await future
+
+    async def __collect(self):
+        # block for the first text, then gather more until the window closes
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self.__collect()
+            # requests cancelled while waiting do not need an embedding
+            batch = [item for item in batch if not item[1].done()]
+            if len(batch) == 0:
+                continue
+
+            now = time.monotonic()
+            self.batch_sizes.observe(len(batch))
+            for _, _, enqueued_at in batch:
+                self.wait_times_ms.observe((now - enqueued_at) * 1000)
+
+            texts = [text for text, _, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(
+                    self.executor, self.encode, texts
+                )
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future, _), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "batch_size": self.batch_sizes.dict(),
+            "queue_depth_on_enqueue": self.queue_depths.dict(),
+            "wait_ms": self.wait_times_ms.dict(),
+        }
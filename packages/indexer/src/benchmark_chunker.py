@@ -0,0 +1,49 @@
+import random
+import sys
+import time
+# langchain is only needed to run this benchmark
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from chunker import DocumentChunker
+from settings import AppSettings
+
+settings = AppSettings()
+
+
+def load_texts():
+    # usage: python benchmark_chunker.py [file.txt ...], defaults to synthetic judgments
+    if len(sys.argv) > 1:
+        return [open(path, encoding="utf-8").read() for path in sys.argv[1:]]
+
+    random.seed(0)
+    words = ["sentenza", "tribunale", "ricorso", "appello", "giudice", "parte"]
+    paragraphs = [
+        " ".join(random.choice(words) for _ in range(random.randint(20, 200)))
+        for _ in range(5000)
+    ]
+    return ["\n\n".join(paragraphs)]
+
+
+def benchmark(name, chunk):
+    start = time.perf_counter()
+    n_chunks = sum(len(chunk(text)) for text in texts)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {n_chunks} chunks in {elapsed:.3f}s")
+
+
+texts = load_texts()
+print(f"{len(texts)} documents, {sum(len(t) for t in texts)} characters")
+
+text_splitter = RecursiveCharacterTextSplitter(
+    chunk_size=settings.chunk_size, chunk_overlap=settings.chunk_overlap
+)
+chunker = DocumentChunker(
+    chunk_size=settings.chunk_size, chunk_overlap=settings.chunk_overlap
+)
+
+benchmark(
+    "langchain",
+    lambda text: [
+        doc.page_content for doc in text_splitter.create_documents(texts=[text])
+    ],
+)
+benchmark("DocumentChunker", chunker.chunk)
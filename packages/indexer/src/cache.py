@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int, ttl: float = None, max_entries: int = None):
+        # max_bytes bounds the sum of the sizes of the cached values
+        self.max_bytes = max_bytes
+        # seconds after which an entry expires, None means never
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.current_bytes -= size
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, _, expires_at = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self.__remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # mark as most recently used
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size: int):
+        if size > self.max_bytes:
+            # the value would evict the whole cache, do not store it
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+
+            expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (value, size, expires_at)
+            self.current_bytes += size
+
+            # evict least recently used entries until the cache fits its bounds
+            while self.current_bytes > self.max_bytes or (
+                self.max_entries is not None and len(self.entries) > self.max_entries
+            ):
+                self.__remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.__remove(key)
+                return True
+            return False
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
@@ -1,16 +1,205 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import re
+from bisect import bisect_left
+from collections import deque
+
+
+def strip_span(text: str, start: int, end: int):
+    # (start, end, text) without surrounding whitespace, None if nothing is left
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    if start == end:
+        return None
+    return start, end, text[start:end]
 
 
 class DocumentChunker:
+    # same separators and size/overlap semantics as langchain's
+    # RecursiveCharacterTextSplitter, but chunks keep their character offsets
+    separators = ["\n\n", "\n", " ", ""]
+
     def __init__(self, chunk_size: int, chunk_overlap: int, length_function=len):
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            length_function=length_function,
-        )
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.length_function = length_function
 
     def chunk(self, text: str):
+        return [chunk for _, _, chunk in self.spans(text)]
+
+    def chunk_many(self, texts: list):
+        return [self.chunk(text) for text in texts]
+
+    def spans(self, text: str):
+        # lazily yields (start, end, text) for each chunk, text == text[start:end]
+        return self.__split(text, 0, len(text), self.separators)
+
+    def __split_on(self, text: str, start: int, end: int, separator: str):
+        # yields (start, end, piece) for the non empty pieces of the span
+        if separator == "":
+            for i in range(start, end):
+                yield i, i + 1, text[i]
+            return
+
+        separator_len = len(separator)
+        for piece in text[start:end].split(separator):
+            piece_end = start + len(piece)
+            if piece:
+                yield start, piece_end, piece
+            start = piece_end + separator_len
+
+    def __split(self, text: str, start: int, end: int, separators: list):
+        # use the first separator found in the span, then recurse on the rest
+        separator = separators[-1]
+        next_separators = []
+        for i, s in enumerate(separators):
+            if s == "":
+                separator = s
+                break
+            if text.find(s, start, end) != -1:
+                separator = s
+                next_separators = separators[i + 1 :]
+                break
+
+        separator_len = self.length_function(separator)
+        good_splits = []
+        for split_start, split_end, piece in self.__split_on(
+            text, start, end, separator
+        ):
+            length = self.length_function(piece)
+            if length < self.chunk_size:
+                good_splits.append((split_start, split_end, length))
+                continue
+
+            if good_splits:
+                yield from self.__merge(text, good_splits, separator_len)
+                good_splits = []
+            if not next_separators:
+                span = strip_span(text, split_start, split_end)
+                if span is not None:
+                    yield span
+            else:
+                yield from self.__split(text, split_start, split_end, next_separators)
+
+        if good_splits:
+            yield from self.__merge(text, good_splits, separator_len)
+
+    def __merge(self, text: str, splits: list, separator_len: int):
+        current = deque()
+        total = 0
+
+        for split_start, split_end, length in splits:
+            if total + length + (separator_len if current else 0) > self.chunk_size:
+                if current:
+                    span = strip_span(text, current[0][0], current[-1][1])
+                    if span is not None:
+                        yield span
+                    # keep at most chunk_overlap of the previous chunk
+                    while total > self.chunk_overlap or (
+                        total + length + (separator_len if current else 0)
+                        > self.chunk_size
+                        and total > 0
+                    ):
+                        total -= current[0][2] + (
+                            separator_len if len(current) > 1 else 0
+                        )
+                        current.popleft()
+
+            current.append((split_start, split_end, length))
+            total += length + (separator_len if len(current) > 1 else 0)
+
+        if current:
+            span = strip_span(text, current[0][0], current[-1][1])
+            if span is not None:
+                yield span
+
+
+class TokenChunker:
+    # chunks measured in tokens of the embedding model, so that every chunk
+    # fills the model sequence length without being truncated
+    sentence_break = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+    def __init__(self, tokenizer, max_tokens: int, chunk_overlap: int = 0):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.chunk_overlap = chunk_overlap
+
+    @classmethod
+    def from_model(cls, model, max_tokens: int = 0, chunk_overlap: int = 0):
+        # defaults to the sequence limit of a SentenceTransformer model
+        tokenizer = model.tokenizer
+        limit = model.max_seq_length - tokenizer.num_special_tokens_to_add(pair=False)
+        if max_tokens <= 0 or max_tokens > limit:
+            max_tokens = limit
+        return cls(tokenizer, max_tokens=max_tokens, chunk_overlap=chunk_overlap)
+
+    def chunk(self, text: str):
+        return self.chunk_many([text])[0]
+
+    def chunk_many(self, texts: list):
+        return [[chunk for _, _, chunk in spans] for spans in self.spans_many(texts)]
+
+    def spans(self, text: str):
+        return self.spans_many([text])[0]
+
+    def spans_many(self, texts: list):
+        # the whole batch of documents is tokenized with a single call
+        encodings = self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            verbose=False,
+        )
+
         return [
-            doc.page_content
-            for doc in self.text_splitter.create_documents(texts=[text])
+            list(self.__split(text, offsets))
+            for text, offsets in zip(texts, encodings["offset_mapping"])
         ]
+
+    def __split(self, text: str, offsets: list):
+        if len(offsets) == 0:
+            return
+
+        # token indices where a sentence starts
+        token_starts = [start for start, _ in offsets]
+        breaks = sorted(
+            set(
+                bisect_left(token_starts, match.end())
+                for match in self.sentence_break.finditer(text)
+            )
+        )
+
+        start = 0
+        while start < len(offsets):
+            end = min(start + self.max_tokens, len(offsets))
+
+            if end < len(offsets):
+                # prefer the last sentence break that keeps the chunk at least half full
+                i = bisect_left(breaks, end + 1) - 1
+                if i >= 0 and breaks[i] - start >= self.max_tokens // 2:
+                    end = breaks[i]
+
+            span = strip_span(text, offsets[start][0], offsets[end - 1][1])
+            if span is not None:
+                yield span
+
+            if end == len(offsets):
+                break
+            start = max(end - self.chunk_overlap, start + 1)
+
+
+def create_chunker(
+    mode: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    model=None,
+    max_tokens: int = 0,
+    chunk_overlap_tokens: int = 0,
+):
+    # "tokens" needs the embedding model to measure chunks with its tokenizer
+    if mode == "tokens":
+        return TokenChunker.from_model(
+            model, max_tokens=max_tokens, chunk_overlap=chunk_overlap_tokens
+        )
+    return DocumentChunker(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
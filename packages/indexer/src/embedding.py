@@ -0,0 +1,117 @@
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+
+def select_device(device: str = "auto"):
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def load_embedding_model(
+    name: str, device: str = "auto", quantize: bool = False, num_threads: int = 0
+):
+    device = select_device(device)
+
+    if device == "cpu" and num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+    model = SentenceTransformer(name, device=device)
+    model.eval()
+
+    if device == "cpu" and quantize:
+        # int8 weights for the linear layers, activations quantized on the fly
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    return model
+
+
+def parity_check(reference, candidate, texts: list):
+    # cosine similarity between the embeddings of the two models, 1.0 is no drift
+    with torch.no_grad():
+        expected = reference.encode(texts, normalize_embeddings=True)
+        actual = candidate.encode(texts, normalize_embeddings=True)
+
+    cosine = (expected * actual).sum(axis=1)
+    return {
+        "n_texts": len(texts),
+        "mean_cosine": float(cosine.mean()),
+        "min_cosine": float(cosine.min()),
+        "max_drift": float(1 - cosine.min()),
+    }
+
+
+def token_budget_batches(lengths: list, token_budget: int):
+    # indices sorted by length, grouped so that each padded batch fits the budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+
+    batches = []
+    batch = []
+    for i in order:
+        # the first (longest) item sets the padded length of the whole batch
+        padded_length = lengths[batch[0]] if batch else lengths[i]
+        if batch and (len(batch) + 1) * padded_length > token_budget:
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode_batched(model, texts: list, token_budget: int, cache=None):
+    # encode texts in length sorted batches, to avoid padding short texts to
+    # the longest one, and return the embeddings in the original order
+    if cache is None:
+        return _encode_batched(model, texts, token_budget)
+
+    # only the texts never seen before go through the model
+    embeddings = np.zeros(
+        (len(texts), model.get_sentence_embedding_dimension()), np.float32
+    )
+    missing = []
+    for i, embedding in enumerate(cache.get_many(texts)):
+        if embedding is None:
+            missing.append(i)
+        else:
+            embeddings[i] = embedding
+
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        missing_embeddings = _encode_batched(model, missing_texts, token_budget)
+        cache.put_many(missing_texts, missing_embeddings)
+        embeddings[missing] = missing_embeddings
+
+    return embeddings
+
+
+def _encode_batched(model, texts: list, token_budget: int):
+    if len(texts) == 0:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), np.float32)
+
+    lengths = [
+        len(ids)
+        for ids in model.tokenizer(
+            texts, truncation=True, max_length=model.max_seq_length, verbose=False
+        )["input_ids"]
+    ]
+
+    embeddings = None
+    with torch.no_grad():
+        for batch in token_budget_batches(lengths, token_budget):
+            batch_embeddings = model.encode(
+                [texts[i] for i in batch],
+                batch_size=len(batch),
+                convert_to_numpy=True,
+            )
+            if embeddings is None:
+                embeddings = np.empty(
+                    (len(texts), batch_embeddings.shape[1]), batch_embeddings.dtype
+                )
+            embeddings[batch] = batch_embeddings
+
+    return embeddings
@@ -0,0 +1,261 @@
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+from cache import LRUCache
+
+
+def normalize_query(text: str):
+    # queries that differ only by whitespace share the same embedding
+    return " ".join(text.split())
+
+
+class QueryEmbeddingCache:
+    def __init__(self, model_name: str, max_bytes: int, path: str = None):
+        self.model_name = model_name
+        self.memory = LRUCache(max_bytes=max_bytes)
+
+        # optional persistent tier that survives restarts
+        self.db = None
+        self.db_lock = threading.Lock()
+        self.disk_hits = 0
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+            self.db.commit()
+
+    def __key(self, text: str):
+        key = self.model_name + "\0" + normalize_query(text)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, text: str):
+        # memory tier only, it never blocks
+        return self.memory.get(self.__key(text))
+
+    def get_stored(self, text: str):
+        # disk tier, blocking: async callers run it on a thread pool
+        key = self.__key(text)
+        with self.db_lock:
+            if self.db is None:
+                return None
+            row = self.db.execute(
+                "SELECT embedding FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        self.disk_hits += 1
+        embedding = np.frombuffer(row[0], dtype=np.float32)
+        self.memory.set(key, embedding, embedding.nbytes)
+        return embedding
+
+    def set(self, text: str, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.memory.set(self.__key(text), embedding, embedding.nbytes)
+
+    def store(self, text: str, embedding):
+        # disk tier, blocking like get_stored
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self.db_lock:
+            if self.db is None:
+                return
+            self.db.execute(
+                "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?)",
+                (self.__key(text), embedding.tobytes()),
+            )
+            self.db.commit()
+
+    def persistent(self):
+        return self.db is not None
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            **self.memory.stats(),
+            "disk_hits": self.disk_hits,
+        }
+
+    def close(self):
+        with self.db_lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+class ChunkEmbeddingCache:
+    # persistent cache of chunk embeddings keyed by model and hash of the text.
+    # vectors are appended to a raw array file read through a memory map, the
+    # key file holds the sha256 digest of each row, in the same order. The
+    # directory is shared by processes: appends hold an exclusive lock on the
+    # lock file and start from the rows on disk, not from the in memory index
+    def __init__(self, directory: str, model_name: str, dtype: str = "float16"):
+        model_key = hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory, model_key)
+        os.makedirs(self.path, exist_ok=True)
+
+        self.model_name = model_name
+        self.dtype = np.dtype(dtype)
+        self.dim = None
+        self.index = {}
+        self.data = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self.meta_path = os.path.join(self.path, "meta.json")
+        self.keys_path = os.path.join(self.path, "keys.bin")
+        self.data_path = os.path.join(self.path, "embeddings.bin")
+        self.lock_file = open(os.path.join(self.path, "lock"), "a")
+
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self.__sync()
+                # rows without their key and partial keys left by an
+                # interrupted write are cut, so the row of a key is always its
+                # position in the key file
+                self.__truncate(len(self.index))
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def __sync(self):
+        # reads the rows appended since the last sync, by this process or
+        # others. Called with the file lock held, so no append is half done
+        if self.dim is None:
+            if not os.path.exists(self.meta_path):
+                return
+            with open(self.meta_path) as f:
+                meta = json.load(f)
+            self.dim = meta["dim"]
+            self.dtype = np.dtype(meta["dtype"])
+
+        n_keys = 0
+        if os.path.exists(self.keys_path):
+            n_keys = os.path.getsize(self.keys_path) // 32
+        n_rows = 0
+        if os.path.exists(self.data_path):
+            n_rows = os.path.getsize(self.data_path) // self.__row_bytes()
+        n_keys = min(n_keys, n_rows)
+
+        start = len(self.index)
+        if n_keys <= start:
+            return
+        with open(self.keys_path, "rb") as f:
+            f.seek(start * 32)
+            keys = f.read((n_keys - start) * 32)
+        for i in range(n_keys - start):
+            self.index[keys[i * 32 : (i + 1) * 32]] = start + i
+
+    def __row_bytes(self):
+        return self.dim * self.dtype.itemsize
+
+    def __truncate(self, n_rows: int):
+        if self.dim is None:
+            return
+        for path, size in [
+            (self.keys_path, n_rows * 32),
+            (self.data_path, n_rows * self.__row_bytes()),
+        ]:
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                with open(path, "r+b") as f:
+                    f.truncate(size)
+
+    def __key(self, text: str):
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def __rows(self, n_rows: int):
+        # remap when the file has grown past the current mapping
+        if self.data is None or self.data.shape[0] < n_rows:
+            self.data = np.memmap(
+                self.data_path, dtype=self.dtype, mode="r", shape=(n_rows, self.dim)
+            )
+        return self.data
+
+    def get_many(self, texts: list):
+        # returns the cached embeddings (None when missing) as float32 arrays
+        keys = [self.__key(text) for text in texts]
+        with self.lock:
+            rows = [self.index.get(key) for key in keys]
+            if None in rows:
+                # the missing rows may have been appended by another process
+                fcntl.flock(self.lock_file, fcntl.LOCK_SH)
+                try:
+                    self.__sync()
+                finally:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+                rows = [self.index.get(key) for key in keys]
+
+            found = [row for row in rows if row is not None]
+            data = self.__rows(max(found) + 1) if found else None
+            self.hits += len(found)
+            self.misses += len(rows) - len(found)
+
+        return [
+            np.array(data[row], dtype=np.float32) if row is not None else None
+            for row in rows
+        ]
+
+    def put_many(self, texts: list, embeddings):
+        embeddings = np.asarray(embeddings)
+        with self.lock:
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+            try:
+                self.__append(texts, embeddings)
+            finally:
+                fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def __append(self, texts: list, embeddings):
+        # new rows go after the rows on disk, other processes may have added
+        # some since the last sync
+        self.__sync()
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            with open(self.meta_path, "w") as f:
+                json.dump(
+                    {
+                        "model": self.model_name,
+                        "dim": self.dim,
+                        "dtype": self.dtype.name,
+                    },
+                    f,
+                )
+        # leftovers of a writer that died during an append
+        self.__truncate(len(self.index))
+
+        new_keys = {}
+        new_rows = []
+        for text, embedding in zip(texts, embeddings):
+            key = self.__key(text)
+            if key not in self.index and key not in new_keys:
+                new_keys[key] = len(self.index) + len(new_rows)
+                new_rows.append(embedding)
+        if len(new_keys) == 0:
+            return
+
+        # vectors first, so a crash never leaves a key without its vector
+        try:
+            with open(self.data_path, "ab") as f:
+                f.write(np.asarray(new_rows, dtype=self.dtype).tobytes())
+            with open(self.keys_path, "ab") as f:
+                f.write(b"".join(new_keys))
+        except Exception:
+            # drop what was appended, rows must stay aligned with keys
+            self.__truncate(len(self.index))
+            raise
+
+        self.index.update(new_keys)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "model": self.model_name,
+                "entries": len(self.index),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
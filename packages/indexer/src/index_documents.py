@@ -1,7 +1,9 @@
-from tqdm import tqdm
 import requests
 from retriever import DocumentRetriever
 from indexer import ChromaIndexer, ElasticsearchIndexer
+from pipeline import Pipeline, Stage
+from manifest import IndexManifest, content_hash
+from actions import delete_chroma_document
 from settings import AppSettings
 
 settings = AppSettings()
@@ -14,34 +16,168 @@ chroma_indexer = ChromaIndexer(
     settings.embedding_model,
     chunk_size=settings.chunk_size,
     chunk_overlap=settings.chunk_overlap,
+    chunk_mode=settings.chunk_mode,
+    chunk_max_tokens=settings.chunk_max_tokens,
+    chunk_overlap_tokens=settings.chunk_overlap_tokens,
+    embedding_token_budget=settings.embedding_token_budget,
+    device=settings.embedding_device,
+    embedding_cache_dir=settings.embedding_cache_dir,
 )
 elastic_indexer = ElasticsearchIndexer(anonymize_type=["persona"])
 
+# documents already indexed with the same content and settings are skipped
+manifest = IndexManifest(
+    settings.index_manifest_path,
+    params={
+        "embedding_model": settings.embedding_model,
+        "chunk_mode": settings.chunk_mode,
+        "chunk_size": settings.chunk_size,
+        "chunk_overlap": settings.chunk_overlap,
+        "chunk_max_tokens": settings.chunk_max_tokens,
+        "chunk_overlap_tokens": settings.chunk_overlap_tokens,
+    },
+)
+
 # create indexes if they do not exist
 chroma_indexer.create_index(INDEX_COLLECTION_NAME)
 elastic_indexer.create_index(INDEX_COLLECTION_NAME)
 
+
+def list_documents():
+    # index 20 documents for each domain
+    for domain in domains:
+        documents = requests.get(
+            DOCS_BASE_URL + "/api/mongo/document?limit=20&q=" + domain
+        )
+        for doc in documents.json()["docs"]:
+            yield {"doc_id": doc["id"], "domain": domain}
+
+
+def hydrate(item):
+    # retrieve a full document
+    return {**item, "doc": retriever.retrieve(item["doc_id"])}
+
+
+def diff(item):
+    doc_hash = content_hash(item["doc"])
+    if manifest.is_current(item["doc_id"], doc_hash):
+        return None
+
+    # the document changed, or is not in the manifest yet and may have been
+    # indexed before it existed: remove its chunks before re-indexing it. A
+    # failed delete raises and the document is dropped, so it is not
+    # checkpointed and is tried again by the next run. The elastic document is
+    # overwritten since its id is the mongo id
+    delete_chroma_document("test", str(item["doc_id"]))
+
+    return {**item, "content_hash": doc_hash}
+
+
+def transform(item):
+    return {
+        **item,
+        "elastic_doc": elastic_indexer.to_elastic_doc(item["doc"]),
+        "metadata": {
+            "doc_id": item["doc_id"],
+            "chunk_size": settings.chunk_size,
+            "chunk_mode": settings.chunk_mode,
+            "domain": item["domain"],
+        },
+    }
+
+
+def chunk(items):
+    docs_chunks = chroma_indexer.chunk_many([item["doc"]["text"] for item in items])
+    return [{**item, "chunks": chunks} for item, chunks in zip(items, docs_chunks)]
+
+
+def dedupe(items):
+    docs_chunks = [item["chunks"] for item in items]
+    metadatas = [item["metadata"] for item in items]
+    docs_ids = chroma_indexer.chunk_ids(docs_chunks, metadatas)
+    docs_chunks, docs_ids = chroma_indexer.filter_existing(
+        "test", docs_chunks, docs_ids
+    )
+    return [
+        {**item, "chunks": chunks, "chunk_ids": ids}
+        for item, chunks, ids in zip(items, docs_chunks, docs_ids)
+    ]
+
+
+def embed(items):
+    docs_embeddings = chroma_indexer.embed_chunks([item["chunks"] for item in items])
+    return [
+        {**item, "embeddings": embeddings}
+        for item, embeddings in zip(items, docs_embeddings)
+    ]
+
+
+def write_vector(items):
+    # raises when the write fails, then the batch is dropped and not checkpointed
+    chroma_indexer.write(
+        "test",
+        [item["chunks"] for item in items],
+        [item["embeddings"] for item in items],
+        [item["metadata"] for item in items],
+        [item["chunk_ids"] for item in items],
+    )
+    # embeddings are not needed anymore
+    return [{**item, "chunks": None, "embeddings": None} for item in items]
+
+
+def write_elastic(items):
+    res = elastic_indexer.write("test", [item["elastic_doc"] for item in items])
+    # documents rejected by elastic are indexed again by the next run
+    failed = set(error["index"] for error in res["errors"])
+    for error in res["errors"]:
+        print("Elastic error for", items[error["index"]]["doc_id"], error["error"])
+    return [item for i, item in enumerate(items) if i not in failed]
+
+
+def checkpoint(items):
+    manifest.mark_indexed(
+        [item["doc_id"] for item in items], [item["content_hash"] for item in items]
+    )
+
+
 print("Start indexing")
 domains = ["famiglia", "strada", "bancario"]
-# index 100 documents for each domain
-for domain in domains:
-    documents = requests.get(DOCS_BASE_URL + "/api/mongo/document?limit=20&q=" + domain)
-    documents = documents.json()["docs"]
-
-    print("Indexing documents for domain: " + domain)
-    for doc in tqdm(documents):
-        doc_id = doc["id"]
-        # retrieve a full document
-        current_doc = retriever.retrieve(doc_id)
-        # # index chunks for the document
-        chroma_indexer.index(
-            collection="test",
-            doc=current_doc,
-            metadata={
-                "doc_id": doc_id,
-                "chunk_size": settings.chunk_size,
-                "domain": domain,
-            },
-        )
-        # index elastic
-        elastic_indexer.index(index="test", doc=current_doc)
+
+pipeline = Pipeline(
+    list_documents(),
+    [
+        Stage("hydrate", hydrate, workers=settings.pipeline_io_workers),
+        Stage("diff", diff, workers=settings.pipeline_io_workers),
+        Stage("transform", transform),
+        Stage("chunk", chunk, batch_size=settings.index_batch_size),
+        Stage(
+            "dedupe",
+            dedupe,
+            workers=settings.pipeline_io_workers,
+            batch_size=settings.index_batch_size,
+        ),
+        Stage("embed", embed, batch_size=settings.index_batch_size),
+        Stage(
+            "write-vector",
+            write_vector,
+            workers=settings.pipeline_io_workers,
+            batch_size=settings.index_batch_size,
+        ),
+        Stage(
+            "write-elastic",
+            write_elastic,
+            workers=settings.pipeline_io_workers,
+            batch_size=settings.index_batch_size,
+        ),
+        Stage("checkpoint", checkpoint, batch_size=settings.index_batch_size),
+    ],
+    queue_size=settings.pipeline_queue_size,
+)
+
+# disable refresh and replicas while loading, they are restored at the end
+elastic_indexer.start_load("test")
+try:
+    pipeline.run()
+finally:
+    elastic_indexer.end_load("test")
+    manifest.close()
@@ -1,33 +1,149 @@
-from sentence_transformers import SentenceTransformer
-from chunker import DocumentChunker
+from chunker import create_chunker
 from actions import (
     index_chroma_document,
+    index_chroma_documents,
+    get_existing_chroma_ids,
     create_chroma_collection,
     index_elastic_document,
+    index_elastic_documents,
     create_elastic_index,
+    start_elastic_load,
+    end_elastic_load,
 )
-from utils import anonymize
-import torch
+from embedding import encode_batched, load_embedding_model
+from embedding_cache import ChunkEmbeddingCache
+from utils import anonymize, encode_embeddings, get_chunk_ids
 
 
 class ChromaIndexer:
-    def __init__(self, embedding_model: str, chunk_size: int, chunk_overlap: int):
-        self.embedding_model = SentenceTransformer(embedding_model)
-        self.embedding_model.to("cuda")
-        self.embedding_model.eval()
-
-        self.chunker = DocumentChunker(
-            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    def __init__(
+        self,
+        embedding_model: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        chunk_mode: str = "chars",
+        chunk_max_tokens: int = 0,
+        chunk_overlap_tokens: int = 0,
+        embedding_token_budget: int = 16384,
+        device: str = "auto",
+        embedding_cache_dir: str = "",
+    ):
+        self.embedding_model_name = embedding_model
+        # the model is loaded on first use, bulk indexing embeds on the server
+        self.embedding_model = None
+        self.device = device
+        # chunk embeddings already computed, shared by collections and re-indexes
+        self.embedding_cache = (
+            ChunkEmbeddingCache(embedding_cache_dir, embedding_model)
+            if embedding_cache_dir
+            else None
         )
 
+        self.chunk_mode = chunk_mode
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.chunk_max_tokens = chunk_max_tokens
+        self.chunk_overlap_tokens = chunk_overlap_tokens
+        self.chunker = None
+        # max padded tokens encoded by the model in a single batch
+        self.embedding_token_budget = embedding_token_budget
+
+    def __load_model(self):
+        if self.embedding_model is None:
+            self.embedding_model = load_embedding_model(
+                self.embedding_model_name, device=self.device
+            )
+        return self.embedding_model
+
+    def __get_chunker(self):
+        # token chunking needs the tokenizer of the embedding model
+        if self.chunker is None:
+            self.chunker = create_chunker(
+                self.chunk_mode,
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap,
+                model=self.__load_model() if self.chunk_mode == "tokens" else None,
+                max_tokens=self.chunk_max_tokens,
+                chunk_overlap_tokens=self.chunk_overlap_tokens,
+            )
+        return self.chunker
+
     def __embed(self, text: str):
-        chunks = self.chunker.chunk(text)
-        embeddings = []
-        with torch.no_grad():
-            embeddings = self.embedding_model.encode(chunks)
+        chunks, embeddings = self.__embed_many([text])
+        return chunks[0], embeddings[0]
+
+    def __embed_many(self, texts: list):
+        docs_chunks = self.chunk_many(texts)
+        return docs_chunks, self.embed_chunks(docs_chunks)
+
+    def chunk_many(self, texts: list):
+        return self.__get_chunker().chunk_many(texts)
+
+    def embed_chunks(self, docs_chunks: list):
+        # chunks of all the documents are batched together by token length
+        chunks = [chunk for doc_chunks in docs_chunks for chunk in doc_chunks]
+
+        embeddings = encode_batched(
+            self.__load_model(),
+            chunks,
+            self.embedding_token_budget,
+            cache=self.embedding_cache,
+        )
+
+        docs_embeddings = []
+        start = 0
+        for doc_chunks in docs_chunks:
+            docs_embeddings.append(embeddings[start : start + len(doc_chunks)])
+            start += len(doc_chunks)
+
+        return docs_embeddings
+
+    def chunk_ids(self, docs_chunks: list, metadatas: list):
+        return [
+            get_chunk_ids(chunks, [metadata for _ in chunks])
+            for chunks, metadata in zip(docs_chunks, metadatas)
+        ]
+
+    def filter_existing(self, collection: str, docs_chunks: list, docs_ids: list):
+        # drop the chunks already stored, so they are not embedded again
+        existing = set(
+            get_existing_chroma_ids(collection, [id for ids in docs_ids for id in ids])
+            or []
+        )
+
+        filtered_chunks = []
+        filtered_ids = []
+        for chunks, ids in zip(docs_chunks, docs_ids):
+            keep = [i for i, id in enumerate(ids) if id not in existing]
+            filtered_chunks.append([chunks[i] for i in keep])
+            filtered_ids.append([ids[i] for i in keep])
+
+        return filtered_chunks, filtered_ids
+
+    def write(
+        self,
+        collection: str,
+        docs_chunks: list,
+        docs_embeddings: list,
+        metadatas: list,
+        docs_ids: list = None,
+    ):
+        # all the chunks of the documents are sent with a single request
+        document = {
+            "documents": [c for chunks in docs_chunks for c in chunks],
+            "embeddings_b64": encode_embeddings(
+                [e for embs in docs_embeddings for e in embs]
+            ),
+            "metadatas": [
+                metadata
+                for chunks, metadata in zip(docs_chunks, metadatas)
+                for _ in chunks
+            ],
+        }
+        if docs_ids is not None:
+            document["ids"] = [id for ids in docs_ids for id in ids]
 
-        embeddings = embeddings.tolist()
-        return chunks, embeddings
+        return index_chroma_document(collection, document)
 
     def create_index(self, name: str):
         return create_chroma_collection(name)
@@ -41,7 +157,7 @@ class ChromaIndexer:
             collection,
             {
                 "documents": chunks,
-                "embeddings": embeddings,
+                "embeddings_b64": encode_embeddings(embeddings),
                 "metadatas": metadatas,
             },
         )
@@ -50,6 +166,23 @@ class ChromaIndexer:
 
         return res
 
+    def index_many(
+        self, collection: str, docs: list, metadatas: list, embed_locally=False
+    ):
+        if embed_locally:
+            docs_chunks, docs_embeddings = self.__embed_many(
+                [doc["text"] for doc in docs]
+            )
+            return self.write(collection, docs_chunks, docs_embeddings, metadatas)
+
+        # chunking and embedding happen on the server, in large batches
+        documents = [
+            {"text": doc["text"], "metadata": metadata}
+            for doc, metadata in zip(docs, metadatas)
+        ]
+
+        return index_chroma_documents(collection, documents)
+
 
 class ElasticsearchIndexer:
     def __init__(self, anonymize_type=[]):
@@ -58,7 +191,13 @@ class ElasticsearchIndexer:
     def create_index(self, name: str):
         return create_elastic_index(name)
 
-    def index(self, index: str, doc: dict):
+    def start_load(self, name: str):
+        return start_elastic_load(name)
+
+    def end_load(self, name: str):
+        return end_elastic_load(name)
+
+    def to_elastic_doc(self, doc: dict):
         annotations = [
             {
                 "id": ann["_id"],
@@ -84,7 +223,7 @@ class ElasticsearchIndexer:
             {"type": "anno ruolo", "value": doc["features"].get("annoruolo", "")},
         ]
 
-        elastic_doc = {
+        return {
             "mongo_id": doc["id"],
             "name": doc["name"],
             "text": doc["text"],
@@ -92,4 +231,11 @@ class ElasticsearchIndexer:
             "annotations": annotations,
         }
 
-        return index_elastic_document(index, elastic_doc)
+    def index(self, index: str, doc: dict):
+        return index_elastic_document(index, self.to_elastic_doc(doc))
+
+    def index_many(self, index: str, docs: list):
+        return self.write(index, [self.to_elastic_doc(doc) for doc in docs])
+
+    def write(self, index: str, elastic_docs: list):
+        return index_elastic_documents(index, elastic_docs)
@@ -0,0 +1,37 @@
+import asyncio
+import sys
+import time
+import httpx
+from settings import AppSettings
+
+settings = AppSettings()
+
+INDEXER_BASE_URL = (
+    "http://" + settings.host_base_url + ":" + settings.indexer_server_port
+)
+
+queries = ["sentenza", "immobile situato a prato", "separazione", "incidente stradale"]
+
+
+async def run(concurrency: int, n_requests: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(timeout=60) as client:
+
+        async def query(i):
+            async with semaphore:
+                await client.post(
+                    INDEXER_BASE_URL + "/elastic/index/test/query",
+                    json={"text": queries[i % len(queries)], "page": 1},
+                )
+
+        start = time.monotonic()
+        await asyncio.gather(*[query(i) for i in range(n_requests)])
+        return n_requests / (time.monotonic() - start)
+
+
+# usage: python load_test.py [n_requests]
+n_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+for concurrency in [1, 2, 4, 8, 16, 32]:
+    rps = asyncio.run(run(concurrency, n_requests))
+    print(f"concurrency {concurrency}: {rps:.1f} req/s")
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def content_hash(doc: dict):
+    return hashlib.sha256(
+        json.dumps(doc, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+class IndexManifest:
+    # local record of what has been indexed, so that a run can skip unchanged
+    # documents and resume after a crash
+    def __init__(self, path: str, params: dict):
+        # params are the chunking and embedding settings, changing them
+        # invalidates every document in the manifest
+        self.params_hash = content_hash(params)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        with self.lock:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS documents ("
+                "doc_id TEXT PRIMARY KEY, "
+                "content_hash TEXT NOT NULL, "
+                "params_hash TEXT NOT NULL, "
+                "indexed_at REAL NOT NULL)"
+            )
+            self.db.commit()
+
+    def get(self, doc_id: str):
+        with self.lock:
+            return self.db.execute(
+                "SELECT content_hash, params_hash FROM documents WHERE doc_id = ?",
+                (str(doc_id),),
+            ).fetchone()
+
+    def is_current(self, doc_id: str, doc_hash: str):
+        return self.get(doc_id) == (doc_hash, self.params_hash)
+
+    def mark_indexed(self, doc_ids: list, doc_hashes: list):
+        # checkpoint, called once the documents are written to every index
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?)",
+                [
+                    (str(doc_id), doc_hash, self.params_hash, now)
+                    for doc_id, doc_hash in zip(doc_ids, doc_hashes)
+                ],
+            )
+            self.db.commit()
+
+    def close(self):
+        self.db.close()
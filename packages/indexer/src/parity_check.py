@@ -0,0 +1,25 @@
+import json
+from embedding import load_embedding_model, parity_check
+from settings import AppSettings
+
+settings = AppSettings()
+
+texts = [
+    "sentenza",
+    "immobile situato a prato",
+    "il ricorso è respinto e le spese di lite sono compensate",
+    "separazione consensuale dei coniugi con affidamento condiviso dei figli",
+    "risarcimento del danno da incidente stradale",
+    "contratto di mutuo e interessi usurari applicati dalla banca",
+]
+
+# the reference is the full precision model, the candidate the configured backend
+reference = load_embedding_model(settings.embedding_model, device="cpu")
+candidate = load_embedding_model(
+    settings.embedding_model,
+    device=settings.embedding_device,
+    quantize=settings.embedding_quantize,
+    num_threads=settings.embedding_num_threads,
+)
+
+print(json.dumps(parity_check(reference, candidate, texts), indent=4))
@@ -0,0 +1,151 @@
+import queue
+import threading
+import time
+import traceback
+
+# marks the end of the stream between two stages
+_DONE = object()
+
+
+class Stage:
+    def __init__(self, name: str, fn, workers: int = 1, batch_size: int = 1):
+        # fn receives an item, or a list of items when batch_size > 1, and
+        # returns the output item(s) in the same form, None drops the item
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.batch_size = batch_size
+
+        self.input = None
+        self.output = None
+
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.busy_time = 0.0
+
+    def __next_batch(self):
+        item = self.input.get()
+        if item is _DONE:
+            return None
+        batch = [item]
+
+        while len(batch) < self.batch_size:
+            try:
+                item = self.input.get(timeout=0.05)
+            except queue.Empty:
+                break
+            if item is _DONE:
+                # let the other workers see the end of the stream too
+                self.input.put(_DONE)
+                break
+            batch.append(item)
+
+        return batch
+
+    def __emit(self, result):
+        if result is None or self.output is None:
+            return
+        for item in result if self.batch_size > 1 else [result]:
+            if item is not None:
+                self.output.put(item)
+
+    def run(self):
+        while True:
+            batch = self.__next_batch()
+            if batch is None:
+                self.input.put(_DONE)
+                return
+
+            start = time.monotonic()
+            try:
+                self.__emit(self.fn(batch if self.batch_size > 1 else batch[0]))
+                errors = 0
+            except Exception:
+                traceback.print_exc()
+                errors = len(batch)
+
+            with self.lock:
+                self.busy_time += time.monotonic() - start
+                self.processed += len(batch) - errors
+                self.errors += errors
+
+    def stats(self, elapsed: float):
+        return {
+            "stage": self.name,
+            "processed": self.processed,
+            "errors": self.errors,
+            "rate": self.processed / elapsed if elapsed > 0 else 0,
+            "queue": self.input.qsize(),
+        }
+
+
+class Pipeline:
+    def __init__(self, source, stages: list, queue_size: int = 64):
+        # source is an iterable of items fed to the first stage
+        self.source = source
+        self.stages = stages
+        # raised by run once the stages have drained
+        self.source_error = None
+
+        # bounded queues give backpressure to the faster stages
+        for i, stage in enumerate(stages):
+            stage.input = queue.Queue(maxsize=queue_size)
+            if i > 0:
+                stages[i - 1].output = stage.input
+
+    def __feed(self):
+        try:
+            for item in self.source:
+                self.stages[0].input.put(item)
+        except Exception as e:
+            traceback.print_exc()
+            self.source_error = e
+        finally:
+            # the stages always end, even when the source fails
+            self.stages[0].input.put(_DONE)
+
+    def __report(self, elapsed: float):
+        print(
+            " | ".join(
+                "{stage}: {processed} ({rate:.1f}/s, queue {queue})".format(
+                    **stage.stats(elapsed)
+                )
+                for stage in self.stages
+            ),
+            flush=True,
+        )
+
+    def run(self, report_every: float = 5.0):
+        start = time.monotonic()
+
+        feeder = threading.Thread(target=self.__feed, daemon=True)
+        feeder.start()
+
+        stage_threads = []
+        for stage in self.stages:
+            threads = [
+                threading.Thread(target=stage.run, daemon=True)
+                for _ in range(stage.workers)
+            ]
+            for thread in threads:
+                thread.start()
+            stage_threads.append(threads)
+
+        # a stage is finished when all its workers are, then the next one ends
+        for i, threads in enumerate(stage_threads):
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout=report_every)
+                    if thread.is_alive():
+                        self.__report(time.monotonic() - start)
+            # drop the end marker left in the queue by the last worker
+            while not self.stages[i].input.empty():
+                self.stages[i].input.get_nowait()
+            if i + 1 < len(self.stages):
+                self.stages[i + 1].input.put(_DONE)
+
+        self.__report(time.monotonic() - start)
+        if self.source_error is not None:
+            raise self.source_error
+        return [stage.stats(time.monotonic() - start) for stage in self.stages]
@@ -1,10 +1,136 @@
+import asyncio
+import threading
+import httpx
 import requests
+from cache import LRUCache
 
 
 class DocumentRetriever:
-    def __init__(self, url: str):
+    def __init__(self, url: str, max_concurrency: int = 16, timeout: float = 10.0):
         self.url = url
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        # pooled async client, created on first use inside the event loop
+        self.async_client = None
 
-    def retrieve(self, id: str):
+    def _fetch(self, id: str):
         res = requests.get(self.url + "/" + str(id))
-        return res.json()
+        return res.json(), len(res.content)
+
+    def retrieve(self, id: str):
+        doc, _ = self._fetch(id)
+        return doc
+
+    def __get_async_client(self):
+        if self.async_client is None:
+            self.async_client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+            )
+        return self.async_client
+
+    async def _afetch(self, id: str):
+        res = await self.__get_async_client().get(self.url + "/" + str(id))
+        res.raise_for_status()
+        return res.json(), len(res.content)
+
+    async def aretrieve(self, id: str):
+        doc, _ = await self._afetch(id)
+        return doc
+
+    async def aretrieve_many(self, ids: list):
+        # fetch all documents concurrently, at most max_concurrency at a time
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded_retrieve(id):
+            # a missing or unreachable document is None, the others are returned
+            async with semaphore:
+                try:
+                    return await self.aretrieve(id)
+                except (httpx.HTTPError, ValueError) as e:
+                    print(e)
+                    return None
+
+        return await asyncio.gather(*[bounded_retrieve(id) for id in ids])
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.aclose()
+            self.async_client = None
+
+
+class CachedDocumentRetriever(DocumentRetriever):
+    def __init__(
+        self,
+        url: str,
+        max_concurrency: int = 16,
+        timeout: float = 10.0,
+        cache_max_bytes: int = 256 * 1024 * 1024,
+        cache_ttl: float = None,
+        coalesce: bool = True,
+    ):
+        super().__init__(url, max_concurrency=max_concurrency, timeout=timeout)
+        # documents are sized by the length of their json payload
+        self.cache = LRUCache(max_bytes=cache_max_bytes, ttl=cache_ttl)
+        # concurrent requests for the same document share a single upstream fetch
+        self.coalesce = coalesce
+        self.inflight = {}
+        self.key_locks = {}
+        self.key_locks_lock = threading.Lock()
+
+    def retrieve(self, id: str):
+        key = str(id)
+        doc = self.cache.get(key)
+        if doc is not None:
+            return doc
+
+        if not self.coalesce:
+            doc, size = self._fetch(id)
+            self.cache.set(key, doc, size)
+            return doc
+
+        with self.key_locks_lock:
+            lock = self.key_locks.setdefault(key, threading.Lock())
+
+        with lock:
+            # another thread may have fetched it while waiting for the lock
+            doc = self.cache.get(key)
+            if doc is None:
+                doc, size = self._fetch(id)
+                self.cache.set(key, doc, size)
+
+        with self.key_locks_lock:
+            self.key_locks.pop(key, None)
+
+        return doc
+
+    async def aretrieve(self, id: str):
+        key = str(id)
+        doc = self.cache.get(key)
+        if doc is not None:
+            return doc
+
+        if not self.coalesce:
+            doc, size = await self._afetch(id)
+            self.cache.set(key, doc, size)
+            return doc
+
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._afetch(id))
+            self.inflight[key] = task
+            task.add_done_callback(lambda _: self.inflight.pop(key, None))
+
+        # shield the shared fetch from the cancellation of a single waiter
+        doc, size = await asyncio.shield(task)
+        self.cache.set(key, doc, size)
+        return doc
+
+    def invalidate(self, id: str):
+        return self.cache.invalidate(str(id))
+
+    def stats(self):
+        return {**self.cache.stats(), "inflight": len(self.inflight)}
@@ -11,6 +11,9 @@ class AppSettings(BaseSettings):
     docs_port: str = os.getenv("DOCS_PORT", "50080")
     # port where chromadb runs
     chroma_port: str = os.getenv("CHROMA_PORT", "8000")
+    # "chroma" uses the chroma server, "flat" an in process index in vector_store_dir
+    vector_store: str = os.getenv("VECTOR_STORE", "chroma")
+    vector_store_dir: str = os.getenv("VECTOR_STORE_DIR", "vector_store")
     # port where elastic runs
     elastic_port: str = os.getenv("ELASTIC_PORT", "9200")
     # the mebedding models used, if you change the model you also have the re-index documents
@@ -20,7 +23,66 @@ class AppSettings(BaseSettings):
         "efederici/sentence-IT5-base"
         # "nickprock/mmarco-bert-base-italian-uncased",
     )
+    # "auto" uses cuda when available, otherwise "cuda" or "cpu"
+    embedding_device: str = os.getenv("EMBEDDING_DEVICE", "auto")
+    # cpu only: dynamic int8 quantization of the model and torch threads (0 = default)
+    embedding_quantize: bool = os.getenv("EMBEDDING_QUANTIZE", "0") == "1"
+    embedding_num_threads: int = int(os.getenv("EMBEDDING_NUM_THREADS", "0"))
+    # directory of the persistent chunk embeddings cache, disabled when empty
+    embedding_cache_dir: str = os.getenv("EMBEDDING_CACHE_DIR", "")
+    # max concurrent requests and timeout (seconds) when fetching documents
+    retriever_max_concurrency: int = int(
+        os.getenv("RETRIEVER_MAX_CONCURRENCY", "16")
+    )
+    retriever_timeout: float = float(os.getenv("RETRIEVER_TIMEOUT", "10"))
+    # size bound (bytes) and time to live (seconds) of the documents cache
+    retriever_cache_max_bytes: int = int(
+        os.getenv("RETRIEVER_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+    )
+    retriever_cache_ttl: float = float(os.getenv("RETRIEVER_CACHE_TTL", "86400"))
+    # share a single fetch between concurrent requests for the same document
+    retriever_cache_coalesce: bool = os.getenv("RETRIEVER_CACHE_COALESCE", "1") == "1"
+    # size bound (bytes) of the in memory query embeddings cache
+    query_embedding_cache_max_bytes: int = int(
+        os.getenv("QUERY_EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+    )
+    # sqlite file used to persist query embeddings, disabled when empty
+    query_embedding_cache_path: str = os.getenv("QUERY_EMBEDDING_CACHE_PATH", "")
+    # max number of queries embedded together and max time (ms) spent waiting for them
+    query_batch_max_size: int = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+    query_batch_max_wait_ms: float = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "5"))
+    # threads used for blocking chromadb calls and for model inference
+    io_thread_pool_size: int = int(os.getenv("IO_THREAD_POOL_SIZE", "32"))
+    model_thread_pool_size: int = int(os.getenv("MODEL_THREAD_POOL_SIZE", "1"))
+    # size bound (bytes) and time to live (seconds) of the elastic facets cache
+    facets_cache_max_bytes: int = int(
+        os.getenv("FACETS_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+    )
+    facets_cache_ttl: float = float(os.getenv("FACETS_CACHE_TTL", "600"))
+    # how long a point in time used by cursor pagination is kept open between pages
+    elastic_pit_keep_alive: str = os.getenv("ELASTIC_PIT_KEEP_ALIVE", "2m")
     chunk_size: int = 200
     chunk_overlap: int = 20
+    # "chars" measures chunks in characters, "tokens" with the embedding tokenizer
+    chunk_mode: str = os.getenv("CHUNK_MODE", "chars")
+    # token mode: max tokens per chunk (0 is the model sequence limit) and overlap
+    chunk_max_tokens: int = int(os.getenv("CHUNK_MAX_TOKENS", "0"))
+    chunk_overlap_tokens: int = int(os.getenv("CHUNK_OVERLAP_TOKENS", "16"))
+    # max padded tokens encoded together by the embedding model
+    embedding_token_budget: int = int(os.getenv("EMBEDDING_TOKEN_BUDGET", "16384"))
+    # number of chunks written to chromadb with a single add call
+    chroma_add_batch_size: int = int(os.getenv("CHROMA_ADD_BATCH_SIZE", "512"))
+    # number of documents sent to the indexer with a single bulk request
+    index_batch_size: int = int(os.getenv("INDEX_BATCH_SIZE", "32"))
+    # max number of documents and bytes sent to elastic with a single bulk request
+    elastic_bulk_chunk_size: int = int(os.getenv("ELASTIC_BULK_CHUNK_SIZE", "500"))
+    elastic_bulk_max_chunk_bytes: int = int(
+        os.getenv("ELASTIC_BULK_MAX_CHUNK_BYTES", str(10 * 1024 * 1024))
+    )
+    # indexing pipeline: workers of the network stages and size of the queues
+    pipeline_io_workers: int = int(os.getenv("PIPELINE_IO_WORKERS", "4"))
+    pipeline_queue_size: int = int(os.getenv("PIPELINE_QUEUE_SIZE", "64"))
+    # sqlite file recording indexed documents, used to skip unchanged ones
+    index_manifest_path: str = os.getenv("INDEX_MANIFEST_PATH", "index_manifest.db")
     # elastic serach index name and chromadb collection name
     index_collection_name: str = "test"
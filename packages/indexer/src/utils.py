@@ -1,3 +1,8 @@
+import base64
+import hashlib
+import numpy as np
+
+
 def get_hits(search_res):
     def convert_hit(hit):
         text = hit["_source"].pop("text")
@@ -7,6 +12,55 @@ def get_hits(search_res):
     return [convert_hit(hit) for hit in search_res["hits"]["hits"]]
 
 
+def get_facets_aggs(n_facets):
+    return {
+        "metadata": {
+            "nested": {"path": "metadata"},
+            "aggs": {
+                "types": {
+                    "terms": {"field": "metadata.type", "size": n_facets},
+                    "aggs": {
+                        "values": {
+                            "terms": {
+                                "field": "metadata.value",
+                                "size": n_facets,
+                                "order": {"_key": "asc"},
+                            }
+                        }
+                    },
+                }
+            },
+        },
+        "annotations": {
+            "nested": {"path": "annotations"},
+            "aggs": {
+                "types": {
+                    "terms": {"field": "annotations.type", "size": n_facets},
+                    "aggs": {
+                        "mentions": {
+                            "terms": {
+                                "field": "annotations.id_ER",
+                                "size": n_facets,
+                            },
+                            "aggs": {
+                                "top_hits_per_mention": {
+                                    "top_hits": {
+                                        "_source": [
+                                            "annotations.display_name",
+                                            "annotations.is_linked",
+                                        ],
+                                        "size": 1,
+                                    }
+                                }
+                            },
+                        }
+                    },
+                }
+            },
+        },
+    }
+
+
 def get_facets_annotations(search_res):
     def convert_annotation_bucket(bucket):
         return {
@@ -55,6 +109,56 @@ def get_facets_metadata(search_res):
     ]
 
 
+def reciprocal_rank_fusion(rankings: dict, weights: dict = {}, k: int = 60):
+    # rankings maps a ranking name to a list of ids, best first
+    scores = {}
+    ranks = {}
+
+    for name, ids in rankings.items():
+        weight = weights.get(name, 1.0)
+        for rank, id in enumerate(ids, start=1):
+            scores[id] = scores.get(id, 0) + weight / (k + rank)
+            ranks.setdefault(id, {})[name] = rank
+
+    fused = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    return [(id, score, ranks[id]) for id, score in fused]
+
+
+def get_chunk_id(doc_id, index: int, text: str):
+    # the same chunk of the same document always gets the same id
+    text_hash = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    key = str(doc_id) + ":" + str(index) + ":" + text_hash
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:32]
+
+
+def get_chunk_ids(chunks: list, metadatas: list):
+    # the chunk index counts the chunks of the same document in order
+    counts = {}
+    ids = []
+    for chunk, metadata in zip(chunks, metadatas or [{} for _ in chunks]):
+        doc_id = metadata.get("doc_id", "")
+        index = counts.get(doc_id, 0)
+        counts[doc_id] = index + 1
+        ids.append(get_chunk_id(doc_id, index, chunk))
+    return ids
+
+
+def encode_embeddings(embeddings):
+    # raw little endian float32 rows, base64 encoded
+    return base64.b64encode(np.asarray(embeddings, dtype="<f4").tobytes()).decode()
+
+
+def decode_embeddings(data: str, n_rows: int):
+    # numpy view over the decoded bytes, without parsing any float. Malformed
+    # data or a size that does not split into n_rows rows raises ValueError
+    embeddings = np.frombuffer(base64.b64decode(data, validate=True), dtype="<f4")
+    if n_rows == 0:
+        return embeddings.reshape(0, 0)
+    if embeddings.size == 0:
+        raise ValueError("No embeddings in the data")
+    return embeddings.reshape(n_rows, -1)
+
+
 def anonymize(s):
     words = s.split()
     new_words = ["".join([word[0]] + ["*" * (len(word) - 1)]) for word in words]
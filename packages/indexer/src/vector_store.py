@@ -0,0 +1,415 @@
+import json
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+import chromadb
+from chromadb.config import Settings
+import numpy as np
+
+
+class IDAlreadyExistsError(ValueError):
+    pass
+
+
+class VectorStore(ABC):
+    # collections returned by a store answer count, add, upsert, get, delete
+    # and query with the same arguments and results of chroma collections
+    # embeddings can be given as a numpy array instead of lists of floats
+    accepts_arrays = False
+
+    @abstractmethod
+    def get_collection(self, name: str):
+        pass
+
+    @abstractmethod
+    def get_or_create_collection(self, name: str):
+        pass
+
+    @abstractmethod
+    def delete_collection(self, name: str):
+        pass
+
+
+class ChromaVectorStore(VectorStore):
+    # collections live on the chroma server, every call is an http request
+    def __init__(self, host: str, port: str):
+        self.client = chromadb.Client(
+            Settings(
+                chroma_api_impl="rest",
+                chroma_server_host=host,
+                chroma_server_http_port=port,
+            )
+        )
+
+    def get_collection(self, name: str):
+        return self.client.get_collection(name=name)
+
+    def get_or_create_collection(self, name: str):
+        return self.client.get_or_create_collection(name=name)
+
+    def delete_collection(self, name: str):
+        return self.client.delete_collection(name=name)
+
+
+class FlatCollection:
+    # exact nearest neighbours in process, embeddings are rows of a memory
+    # mapped float32 matrix and ids, documents and metadatas are kept in sqlite
+    def __init__(self, name: str, directory: str):
+        self.name = name
+        self.directory = directory
+        self.lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.matrix_path = os.path.join(directory, "embeddings.f32")
+        self.db = sqlite3.connect(
+            os.path.join(directory, "chunks.db"), check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS chunks ("
+            "row INTEGER PRIMARY KEY, "
+            "id TEXT UNIQUE NOT NULL, "
+            "document TEXT, "
+            "metadata TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+        self.db.commit()
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()
+        self.dim = int(row[0]) if row is not None else None
+        self.matrix = None
+        self.capacity = 0
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+
+        # row -> chunk, rows of deleted chunks are reused by later writes
+        self.size = 0
+        self.ids = []
+        self.documents = []
+        self.metadatas = []
+        self.rows = {}
+        self.free = []
+        # metadata key -> value -> rows, used by where filters
+        self.index = {}
+
+        self.__load()
+
+    def __load(self):
+        chunks = self.db.execute(
+            "SELECT row, id, document, metadata FROM chunks ORDER BY row"
+        ).fetchall()
+        if len(chunks) == 0:
+            return
+
+        self.__open_matrix(os.path.getsize(self.matrix_path) // (self.dim * 4))
+        self.__grow(chunks[-1][0] + 1)
+        for row, id, document, metadata in chunks:
+            self.__set_row(row, id, document, json.loads(metadata))
+        self.free = [row for row in range(self.size) if self.ids[row] is None]
+
+        embeddings = self.matrix[: self.size]
+        self.norms[: self.size] = np.einsum("ij,ij->i", embeddings, embeddings)
+
+    def __open_matrix(self, capacity: int):
+        self.matrix = np.memmap(
+            self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim)
+        )
+        self.capacity = capacity
+
+        norms = np.zeros(capacity, dtype=np.float32)
+        norms[: len(self.norms)] = self.norms
+        self.norms = norms
+        alive = np.zeros(capacity, dtype=bool)
+        alive[: len(self.alive)] = self.alive
+        self.alive = alive
+
+    def __grow(self, size: int):
+        # the matrix file at least doubles, so appends are amortized
+        if size > self.capacity:
+            capacity = max(size, 2 * self.capacity, 1024)
+            if self.matrix is not None:
+                self.matrix.flush()
+                del self.matrix
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(capacity * self.dim * 4)
+            self.__open_matrix(capacity)
+
+        if size > self.size:
+            self.ids.extend([None] * (size - self.size))
+            self.documents.extend([None] * (size - self.size))
+            self.metadatas.extend([None] * (size - self.size))
+            self.size = size
+
+    def __set_row(self, row: int, id: str, document, metadata):
+        self.ids[row] = id
+        self.documents[row] = document
+        self.metadatas[row] = metadata
+        self.rows[id] = row
+        self.alive[row] = True
+        for key, value in (metadata or {}).items():
+            self.index.setdefault(key, {}).setdefault(value, set()).add(row)
+
+    def __clear_row(self, row: int):
+        for key, value in (self.metadatas[row] or {}).items():
+            self.index[key][value].discard(row)
+        del self.rows[self.ids[row]]
+        self.ids[row] = None
+        self.documents[row] = None
+        self.metadatas[row] = None
+        self.alive[row] = False
+
+    def __where(self, where: dict):
+        # rows matching a chroma style filter: equality, $eq, $ne, $in, $nin,
+        # $and and $or over metadata values
+        rows = None
+        for key, condition in where.items():
+            if key == "$and":
+                matches = set.intersection(*[self.__where(w) for w in condition])
+            elif key == "$or":
+                matches = set.union(*[self.__where(w) for w in condition])
+            else:
+                values = self.index.get(key, {})
+                if not isinstance(condition, dict):
+                    condition = {"$eq": condition}
+                op, value = next(iter(condition.items()))
+                if op == "$eq":
+                    matches = set(values.get(value, ()))
+                elif op == "$in":
+                    matches = set().union(*[values.get(v, ()) for v in value])
+                elif op == "$ne":
+                    matches = set(self.rows.values()) - values.get(value, set())
+                elif op == "$nin":
+                    matches = set(self.rows.values()).difference(
+                        *[values.get(v, ()) for v in value]
+                    )
+                else:
+                    raise ValueError("Unsupported where operator " + op)
+            rows = matches if rows is None else rows & matches
+        return rows
+
+    def __select(self, rows, include: list):
+        result = {"ids": [self.ids[row] for row in rows]}
+        result["embeddings"] = (
+            [self.matrix[row].tolist() for row in rows]
+            if "embeddings" in include
+            else None
+        )
+        result["documents"] = (
+            [self.documents[row] for row in rows] if "documents" in include else None
+        )
+        result["metadatas"] = (
+            [self.metadatas[row] for row in rows] if "metadatas" in include else None
+        )
+        return result
+
+    def __write(self, ids, embeddings, metadatas, documents, upsert: bool):
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        metadatas = metadatas or [None for _ in ids]
+        documents = documents or [None for _ in ids]
+
+        # the last occurrence wins when an id is repeated in the same write
+        keep = sorted({id: i for i, id in enumerate(ids)}.values())
+        ids = [ids[i] for i in keep]
+        embeddings = embeddings[keep]
+        metadatas = [metadatas[i] for i in keep]
+        documents = [documents[i] for i in keep]
+
+        with self.lock:
+            if not upsert:
+                existing = [id for id in ids if id in self.rows]
+                if len(existing) > 0:
+                    raise IDAlreadyExistsError(
+                        "IDs " + ", ".join(existing) + " already exist"
+                    )
+
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                self.db.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('dim', ?)", (str(self.dim),)
+                )
+            if embeddings.shape[1] != self.dim:
+                raise ValueError(
+                    "Embedding dimension "
+                    + str(embeddings.shape[1])
+                    + " does not match collection dimensionality "
+                    + str(self.dim)
+                )
+
+            rows = []
+            for id in ids:
+                row = self.rows.get(id)
+                if row is None:
+                    row = self.free.pop() if self.free else self.size
+                    self.__grow(row + 1)
+                else:
+                    self.__clear_row(row)
+                rows.append(row)
+
+            self.matrix[rows] = embeddings
+            self.matrix.flush()
+            self.norms[rows] = np.einsum("ij,ij->i", embeddings, embeddings)
+            for row, id, document, metadata in zip(rows, ids, documents, metadatas):
+                self.__set_row(row, id, document, metadata)
+
+            self.db.executemany(
+                "INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)",
+                [
+                    (row, id, document, json.dumps(metadata))
+                    for row, id, document, metadata in zip(
+                        rows, ids, documents, metadatas
+                    )
+                ],
+            )
+            self.db.commit()
+
+    def add(self, ids, embeddings, metadatas=None, documents=None):
+        self.__write(ids, embeddings, metadatas, documents, upsert=False)
+
+    def upsert(self, ids, embeddings, metadatas=None, documents=None):
+        self.__write(ids, embeddings, metadatas, documents, upsert=True)
+
+    def count(self):
+        return len(self.rows)
+
+    def get(self, ids=None, where=None, include=["metadatas", "documents"]):
+        with self.lock:
+            if ids is not None:
+                rows = [self.rows[id] for id in ids if id in self.rows]
+            else:
+                rows = sorted(self.rows.values())
+            if where:
+                matches = self.__where(where)
+                rows = [row for row in rows if row in matches]
+            return self.__select(rows, include)
+
+    def delete(self, ids=None, where=None):
+        with self.lock:
+            if ids is not None:
+                rows = set(self.rows[id] for id in ids if id in self.rows)
+            else:
+                rows = set(self.rows.values())
+            if where:
+                rows &= self.__where(where)
+
+            for row in rows:
+                self.__clear_row(row)
+                self.free.append(row)
+            self.db.executemany(
+                "DELETE FROM chunks WHERE row = ?", [(row,) for row in rows]
+            )
+            self.db.commit()
+
+    def query(
+        self,
+        query_embeddings,
+        n_results: int = 10,
+        where=None,
+        include=["metadatas", "documents", "distances"],
+    ):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        queries = queries.reshape(-1, queries.shape[-1])
+        result = {"ids": [], "distances": [], "documents": [], "metadatas": []}
+        result["embeddings"] = []
+
+        with self.lock:
+            if where:
+                # filtered queries only score the matching rows
+                rows = np.fromiter(self.__where(where), dtype=np.int64)
+                embeddings = self.matrix[rows] if len(rows) > 0 else None
+                norms = self.norms[rows]
+            else:
+                rows = None
+                embeddings = self.matrix[: self.size] if self.size > 0 else None
+                norms = self.norms[: self.size]
+                norms = np.where(self.alive[: self.size], norms, np.inf)
+
+            k = min(n_results, len(norms) if where else len(self.rows))
+            if embeddings is None or k == 0:
+                distances = np.zeros((len(queries), 0), dtype=np.float32)
+            else:
+                # squared l2 distances, the default space of chroma collections
+                distances = (
+                    norms[None, :]
+                    - 2 * queries @ embeddings.T
+                    + np.einsum("ij,ij->i", queries, queries)[:, None]
+                )
+
+            for query_distances in distances:
+                top = np.argpartition(query_distances, k - 1)[:k] if k > 0 else []
+                top = top[np.argsort(query_distances[top])] if k > 0 else top
+                top_rows = rows[top] if rows is not None else top
+                selected = self.__select(top_rows, include)
+                result["ids"].append(selected["ids"])
+                result["distances"].append(query_distances[top].tolist())
+                for key in ["documents", "metadatas", "embeddings"]:
+                    result[key].append(selected[key])
+
+        for key in ["distances", "documents", "metadatas", "embeddings"]:
+            if key not in include:
+                result[key] = None
+        return result
+
+    def dict(self):
+        return {"name": self.name, "id": self.name, "metadata": None}
+
+    def close(self):
+        with self.lock:
+            if self.matrix is not None:
+                self.matrix.flush()
+                self.matrix = None
+            self.db.close()
+
+
+class FlatVectorStore(VectorStore):
+    # embedded store, no network hop and no json between the indexer and the
+    # vectors. Collections are subdirectories of the store directory
+    accepts_arrays = True
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.collections = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def __path(self, name: str):
+        if not re.fullmatch(r"[A-Za-z0-9][A-Za-z0-9_.-]*", name):
+            raise ValueError("Invalid collection name " + name)
+        return os.path.join(self.directory, name)
+
+    def get_collection(self, name: str):
+        with self.lock:
+            if name not in self.collections:
+                path = self.__path(name)
+                if not os.path.isdir(path):
+                    raise ValueError("Collection " + name + " does not exist")
+                self.collections[name] = FlatCollection(name, path)
+            return self.collections[name]
+
+    def get_or_create_collection(self, name: str):
+        with self.lock:
+            if name not in self.collections:
+                self.collections[name] = FlatCollection(name, self.__path(name))
+            return self.collections[name]
+
+    def delete_collection(self, name: str):
+        with self.lock:
+            path = self.__path(name)
+            if not os.path.isdir(path):
+                raise ValueError("Collection " + name + " does not exist")
+            collection = self.collections.pop(name, None)
+            if collection is not None:
+                collection.close()
+            shutil.rmtree(path)
+
+
+def create_vector_store(
+    backend: str, host: str = None, port: str = None, directory: str = None
+):
+    # "flat" keeps the vectors in process, "chroma" uses the chroma server
+    if backend == "flat":
+        return FlatVectorStore(directory)
+    return ChromaVectorStore(host, port)
@@ -3,11 +3,31 @@ from exllama.model import ExLlama, ExLlamaCache, ExLlamaConfig
 from exllama.tokenizer import ExLlamaTokenizer
 from exllama.generator import ExLlamaGenerator
 import os, glob
+import torch
+from functools import lru_cache
 from LLM import LLM
 from prompts import llama_v2_prompt
+from detokenizer import StreamingDetokenizer
+from prefix_cache import PrefixCache
+
+
+def copy_cache_prefix(source: ExLlamaCache, target: ExLlamaCache, length: int):
+    # keys and values are shaped (batch, heads, max_seq_len, head_dim)
+    for states in ["key_states", "value_states"]:
+        for source_layer, target_layer in zip(
+            getattr(source, states), getattr(target, states)
+        ):
+            target_layer[:, :, :length, :].copy_(source_layer[:, :, :length, :])
 
 
 class EXLlamaModel(LLM):
+    def __init__(
+        self, model_diectory: str, gpu_split: str, prefix_cache_bytes: int = 0
+    ):
+        # memory used by cached prompt prefixes, one cache is always kept
+        self.prefix_cache_bytes = prefix_cache_bytes
+        super().__init__(model_diectory, gpu_split)
+
     def _load(self, model_directory: str, gpu_split: str = None):
         tokenizer_path = os.path.join(model_directory, "tokenizer.model")
         model_config_path = os.path.join(model_directory, "config.json")
@@ -32,9 +52,23 @@ class EXLlamaModel(LLM):
             tokenizer_path
         )  # create tokenizer from tokenizer model file
         print("loaded tokenizer")
+        # chat turns are encoded once, later requests of the conversation reuse them
+        self.encode_turn = lru_cache(maxsize=4096)(
+            lambda text: tuple(self.tokenizer.encode(text)[0].tolist())
+        )
 
         self.cache = ExLlamaCache(self.instance)  # create cache for inference
         print("created cache")
+        cache_bytes = sum(
+            states.numel() * states.element_size()
+            for states in self.cache.key_states + self.cache.value_states
+        )
+        self.prefix_cache = PrefixCache(
+            create_cache=lambda: ExLlamaCache(self.instance),
+            copy_prefix=copy_cache_prefix,
+            max_slots=max(1, self.prefix_cache_bytes // cache_bytes),
+            caches=[self.cache],
+        )
         self.generator = ExLlamaGenerator(
             self.instance, self.tokenizer, self.cache
         )  # create generator
@@ -49,52 +83,59 @@ class EXLlamaModel(LLM):
         max_new_tokens: int,
         min_token_reply: int = 256,
     ):
-        return (
-            llama_v2_prompt(messages, max_new_tokens, min_token_reply),
+        # prompt ids fitting max_seq_len together with the reply
+        ids, max_new_tokens = llama_v2_prompt(
+            messages,
             max_new_tokens,
+            min_token_reply,
+            encode=self.encode_turn,
+            bos_id=self.tokenizer.bos_token_id,
+            eos_id=self.tokenizer.eos_token_id,
+            max_seq_len=self.config.max_seq_len,
         )
+        return torch.tensor([ids], dtype=torch.long), max_new_tokens
 
-    async def generate_stream(self, inputs: str, max_new_tokens: int):
-        new_text = ""
-        last_text = ""
-
+    def _begin(self, ids):
+        # continue from the cached sequence sharing the longest prefix with ids
         self.generator.end_beam_search()
-
-        ids = self.tokenizer.encode(inputs)
+        slot = self.prefix_cache.acquire(ids)
+        self.generator.cache = slot.cache
+        self.generator.sequence = slot.sequence
+        self.generator.sequence_actual = slot.sequence
+        # the slot stays empty until generation ends with a consistent cache
+        slot.sequence = None
         self.generator.gen_begin_reuse(ids)
+        return slot
 
-        for i in range(max_new_tokens):
-            token = self.generator.gen_single_token()
-            text = self.tokenizer.decode(self.generator.sequence[0])
-            new_text = text[len(inputs) :]
-
-            # Get new token by taking difference from last response:
-            new_token = new_text.replace(last_text, "")
-            last_text = new_text
-
-            # print(new_token, end="", flush=True)
-            yield new_token
-
-            # [End conditions]:
-            # if break_on_newline and # could add `break_on_newline` as a GenerateRequest option?
-            # if token.item() == tokenizer.newline_token_id:
-            #    print(f"newline_token_id: {tokenizer.newline_token_id}")
-            #    break
-            if token.item() == self.tokenizer.eos_token_id:
-                # print(f"eos_token_id: {tokenizer.eos_token_id}")
-                break
+    async def generate_stream(self, inputs, max_new_tokens: int):
+        # inputs are the prompt ids from prepare_message, or a text
+        ids = self.tokenizer.encode(inputs) if isinstance(inputs, str) else inputs
+        slot = self._begin(ids)
 
-        # all done:
-        self.generator.end_beam_search()
-
-    def generate(self, inputs, max_new_tokens):
-        # No streaming, using generate_simple:
-        response = self.generator.generate_simple(inputs, max_new_tokens)
-        # print(text)
-
-        # remove prompt from response:
-        response = response.replace(inputs, "")
-        response = response.lstrip()
+        # only the last tokens are decoded at each step, not the whole sequence
+        detokenizer = StreamingDetokenizer(
+            self.tokenizer.decode, self.generator.sequence.shape[-1]
+        )
 
-        # return response time here?
-        return {response}
+        try:
+            for i in range(max_new_tokens):
+                token = self.generator.gen_single_token()
+                new_token = detokenizer.step(self.generator.sequence[0])
+
+                # print(new_token, end="", flush=True)
+                yield new_token
+
+                # [End conditions]:
+                # if break_on_newline and # could add `break_on_newline` as a GenerateRequest option?
+                # if token.item() == tokenizer.newline_token_id:
+                #    print(f"newline_token_id: {tokenizer.newline_token_id}")
+                #    break
+                if token.item() == self.tokenizer.eos_token_id:
+                    # print(f"eos_token_id: {tokenizer.eos_token_id}")
+                    break
+
+            # all done:
+            self.generator.end_beam_search()
+        finally:
+            # the cache now holds this sequence, the next turn continues from it
+            self.prefix_cache.update(slot, self.generator.sequence)
@@ -13,9 +13,12 @@ from pydantic import BaseModel
 from typing import Any, Dict, Optional, List
 from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import FastAPI, HTTPException, Request, Response
+from starlette.background import BackgroundTask
 from EXLlamaModel import EXLlamaModel
 from exllama.generator import ExLlamaGenerator
+from scheduler import GenerationQueue, QueueFullError, QueueTimeoutError
+from detokenizer import StopSequenceFilter
 
 
 # exllama imports:
@@ -49,6 +52,24 @@ parser.add_argument(
     type=str,
     help="Comma-separated list of VRAM (in GB) to use per GPU device for model layers, e.g. -gs 20,7,7",
 )
+parser.add_argument(
+    "--prefix_cache_gb",
+    type=float,
+    default=0,
+    help="VRAM (in GB) used to keep the kv cache of recent prompts, 0 keeps only one",
+)
+parser.add_argument(
+    "--max_queue_size",
+    type=int,
+    default=32,
+    help="Max requests waiting for the model, more are rejected with 429",
+)
+parser.add_argument(
+    "--queue_timeout",
+    type=float,
+    default=120,
+    help="Max seconds a request waits for the model before a 503",
+)
 
 args = parser.parse_args()
 
@@ -74,7 +95,10 @@ else:
 
 # Setup FastAPI:
 app = FastAPI()
-semaphore = asyncio.Semaphore(1)
+# requests are served one at a time, in order of arrival
+generation_queue = GenerationQueue(
+    max_size=args.max_queue_size, timeout=args.queue_timeout
+)
 
 # I need open CORS for my setup, you may not!!
 app.add_middleware(
@@ -118,18 +142,95 @@ class GenerateRequest(BaseModel):
     token_repetition_penalty_sustain: Optional[int] = 256
     token_repetition_penalty_decay: Optional[int] = None
     stream: Optional[bool] = True
+    # generation ends as soon as one of these is generated, it is not returned
+    stop: Optional[List[str]] = []
+
+
+@app.get("/queue")
+def queue_stats():
+    return generation_queue.stats()
+
+
+@app.get("/prefix-cache")
+def prefix_cache_stats():
+    return model.prefix_cache.stats()
+
+
+# requests ended early by a disconnected client or a stop sequence, and the
+# tokens they did not generate out of max_new_tokens
+generation_stats = {"cancelled": 0, "stopped": 0, "tokens_saved": 0}
+
+
+@app.get("/generate/stats")
+def get_generation_stats():
+    return generation_stats
+
+
+async def generate_text(stream, request: Request, max_new_tokens: int, stop: list):
+    # stops generating when the client goes away or a stop sequence appears
+    stop_filter = StopSequenceFilter(stop)
+    tokens = 0
+    cancelled = False
+    try:
+        async for token in stream:
+            tokens += 1
+            text = stop_filter.push(token)
+            if text:
+                yield text
+            if stop_filter.stopped:
+                break
+            # also gives the event loop a chance to run between tokens
+            if await request.is_disconnected():
+                cancelled = True
+                break
+        else:
+            text = stop_filter.flush()
+            if text:
+                yield text
+    except (asyncio.CancelledError, GeneratorExit):
+        # the response was cancelled or closed while generating
+        cancelled = True
+        raise
+    finally:
+        # runs the end of generate_stream, the cache is consistent again
+        await stream.aclose()
+        if cancelled or stop_filter.stopped:
+            generation_stats["cancelled" if cancelled else "stopped"] += 1
+            generation_stats["tokens_saved"] += max(max_new_tokens - tokens, 0)
+
+
+async def release_after(stream, slot):
+    # the generation is closed before the next request gets the model
+    await stream.aclose()
+    slot.release()
+
+
+async def stream_and_release(stream, slot):
+    # the model is held until the stream has been generated or abandoned
+    try:
+        async for token in stream:
+            yield token
+    finally:
+        await release_after(stream, slot)
 
 
 @app.post("/generate")
-async def stream_data(req: GenerateRequest):
-    while True:
-        try:
-            # Attempt to acquire the semaphore without waiting, in a loop...
-            await asyncio.wait_for(semaphore.acquire(), timeout=0.1)
-            break
-        except asyncio.TimeoutError:
-            print("Server is busy")
-            await asyncio.sleep(1)
+async def stream_data(req: GenerateRequest, request: Request, response: Response):
+    try:
+        slot = await generation_queue.acquire()
+    except QueueFullError:
+        raise HTTPException(
+            status_code=429, detail="Too many requests waiting, retry later"
+        )
+    except QueueTimeoutError:
+        raise HTTPException(status_code=503, detail="Timed out waiting for the model")
+
+    queue_headers = {
+        "X-Queue-Position": str(slot.position),
+        "X-Queue-Wait-Ms": str(int(slot.waited * 1000)),
+    }
+    streaming = False
+    generation = None
 
     try:
         # Set these from GenerateRequest:
@@ -156,23 +257,46 @@ async def stream_data(req: GenerateRequest):
             max_new_tokens=req.max_new_tokens,
         )
 
+        # copy of generate_simple() so that I could yield each token for streaming without having to change generator.py and make merging updates a nightmare:
+        generation = generate_text(
+            model.generate_stream(_MESSAGE, max_new_tokens),
+            request,
+            max_new_tokens,
+            req.stop,
+        )
+
         if req.stream:
-            # copy of generate_simple() so that I could yield each token for streaming without having to change generator.py and make merging updates a nightmare:
-            return StreamingResponse(model.generate_stream(_MESSAGE, max_new_tokens))
+            stream = StreamingResponse(
+                stream_and_release(generation, slot),
+                headers=queue_headers,
+                # also releases the model when the stream never starts
+                background=BackgroundTask(release_after, generation, slot),
+            )
+            streaming = True
+            return stream
         else:
-            return model.generate(_MESSAGE, max_new_tokens)
+            response.headers.update(queue_headers)
+            return {"".join([token async for token in generation]).lstrip()}
     except Exception as e:
         return {"response": f"Exception while processing request: {e}"}
 
     finally:
-        semaphore.release()
+        # a stream releases the model when it ends
+        if not streaming:
+            if generation is not None:
+                await generation.aclose()
+            slot.release()
 
 
 # -------
 
 
 if __name__ == "__main__":
-    model = EXLlamaModel(args.directory, args.gpu_split)
+    model = EXLlamaModel(
+        args.directory,
+        args.gpu_split,
+        prefix_cache_bytes=int(args.prefix_cache_gb * 1024**3),
+    )
 
     # -------
 
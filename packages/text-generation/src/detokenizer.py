@@ -0,0 +1,54 @@
+class StreamingDetokenizer:
+    # turns generated ids into exact text deltas decoding only the last few
+    # tokens. The window starts some tokens back so sentencepiece sees the
+    # context of leading spaces, and text ending with an incomplete utf-8
+    # character is held back until the next tokens complete it
+    def __init__(self, decode, prompt_length: int, context: int = 5):
+        # decode takes a slice of the sequence and returns its text
+        self.decode = decode
+        self.prefix_offset = max(prompt_length - context, 0)
+        self.read_offset = prompt_length
+
+    def step(self, sequence):
+        # sequence holds every id so far, prompt included
+        prefix_text = self.decode(sequence[self.prefix_offset : self.read_offset])
+        new_text = self.decode(sequence[self.prefix_offset :])
+
+        if len(new_text) > len(prefix_text) and not new_text.endswith("�"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(sequence)
+            return new_text[len(prefix_text) :]
+        return ""
+
+
+class StopSequenceFilter:
+    # holds back streamed text that may be the start of a stop sequence, so
+    # that no part of a stop sequence reaches the client
+    def __init__(self, stop: list):
+        self.stop = [s for s in stop if s]
+        self.pending = ""
+        self.stopped = False
+
+    def push(self, text: str):
+        # returns the text that can be sent
+        self.pending += text
+        ends = [self.pending.find(s) for s in self.stop]
+        ends = [end for end in ends if end >= 0]
+        if len(ends) > 0:
+            self.stopped = True
+            text, self.pending = self.pending[: min(ends)], ""
+            return text
+
+        keep = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(self.pending)), keep, -1):
+                if self.pending.endswith(s[:n]):
+                    keep = n
+                    break
+        text = self.pending[: len(self.pending) - keep]
+        self.pending = self.pending[len(self.pending) - keep :]
+        return text
+
+    def flush(self):
+        text, self.pending = self.pending, ""
+        return text
@@ -0,0 +1,105 @@
+import time
+
+
+def common_prefix_length(a, b):
+    n = min(a.shape[-1], b.shape[-1])
+    mismatches = (a[:n] != b[:n]).nonzero()
+    return mismatches[0].item() if len(mismatches) > 0 else n
+
+
+class PrefixSlot:
+    def __init__(self, cache):
+        self.cache = cache
+        # tokens whose keys and values are in the cache, None when empty
+        self.sequence = None
+        self.last_used = time.monotonic()
+
+
+class PrefixCache:
+    # a bounded set of kv caches, each holding the last sequence generated
+    # with it. A new prompt continues from the slot sharing its longest prefix,
+    # so chat turns and prompts with the same system prompt skip most of the
+    # prefill. Slots are created up to max_slots and then evicted by lru
+    def __init__(
+        self, create_cache, copy_prefix, max_slots: int, caches=[], min_prefix=2
+    ):
+        # copy_prefix(source, target, length) copies the first length positions
+        self.create_cache = create_cache
+        self.copy_prefix = copy_prefix
+        self.max_slots = max_slots
+        # shorter prefixes are not worth reusing, the generator starts over
+        self.min_prefix = min_prefix
+        self.slots = [PrefixSlot(cache) for cache in caches]
+
+        self.requests = 0
+        self.reused_tokens = 0
+        self.prompt_tokens = 0
+        self.evictions = 0
+
+    def __free_slot(self, exclude=None):
+        # an unused slot, a new one while under the budget or the lru one
+        slots = [slot for slot in self.slots if slot is not exclude]
+        empty = [slot for slot in slots if slot.sequence is None]
+        if len(empty) > 0:
+            return empty[0]
+        if len(self.slots) < self.max_slots:
+            slot = PrefixSlot(self.create_cache())
+            self.slots.append(slot)
+            return slot
+        if len(slots) == 0:
+            return None
+
+        slot = min(slots, key=lambda slot: slot.last_used)
+        slot.sequence = None
+        slot.cache.current_seq_len = 0
+        self.evictions += 1
+        return slot
+
+    def acquire(self, ids):
+        # ids is the prompt, shaped (1, length)
+        best, best_length = None, 0
+        # on equal prefixes the most recently used slot wins
+        for slot in sorted(self.slots, key=lambda slot: -slot.last_used):
+            if slot.sequence is None:
+                continue
+            length = common_prefix_length(slot.sequence[0], ids[0])
+            if length > best_length:
+                best, best_length = slot, length
+
+        self.requests += 1
+        self.prompt_tokens += ids.shape[-1]
+
+        if best is None or best_length < self.min_prefix:
+            slot = self.__free_slot()
+        elif best_length < best.sequence.shape[-1]:
+            # the prompt diverges from the cached sequence, continue in another
+            # slot so the longer sequence stays cached for its own next turn
+            slot = self.__free_slot(exclude=best)
+            if slot is None:
+                slot = best
+            else:
+                self.copy_prefix(best.cache, slot.cache, best_length)
+                slot.sequence = best.sequence[:, :best_length]
+                slot.cache.current_seq_len = best_length - 1
+            self.reused_tokens += best_length
+        else:
+            slot = best
+            self.reused_tokens += best_length
+
+        slot.last_used = time.monotonic()
+        return slot
+
+    def update(self, slot, sequence):
+        # called once generation ends, sequence matches the cache contents
+        slot.sequence = sequence
+        slot.last_used = time.monotonic()
+
+    def stats(self):
+        return {
+            "slots": len(self.slots),
+            "max_slots": self.max_slots,
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "reused_tokens": self.reused_tokens,
+            "evictions": self.evictions,
+        }
@@ -2,11 +2,19 @@ from __future__ import annotations
 
 
 def llama_v2_prompt(
-    messages: list[dict], max_new_tokens: int, min_token_reply: int = 256
+    messages: list[dict],
+    max_new_tokens: int,
+    min_token_reply: int = 256,
+    encode=None,
+    bos_id: int = 1,
+    eos_id: int = 2,
+    max_seq_len: int = 2048,
 ):
+    # returns the prompt token ids and the tokens left for the reply. Each turn
+    # is encoded on its own with encode(text) -> ids, so repeated turns can be
+    # cached, and the oldest turns are dropped when the prompt does not fit
     B_INST, E_INST = "[INST]", "[/INST]"
     B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
-    BOS, EOS = "<s>", "</s>"
     DEFAULT_SYSTEM_PROMPT = f"""SYSTEM: You are a helpful, respectful and honest assistant. Always answer as helpfully as possible, while being safe. Please ensure that your responses are socially unbiased and positive in nature. If a question does not make any sense, or is not factually coherent, explain why instead of answering something not correct. If you don't know the answer to a question, please don't share false information."""
 
     if messages[0]["role"] != "system":
@@ -16,17 +24,52 @@ def llama_v2_prompt(
                 "content": DEFAULT_SYSTEM_PROMPT,
             }
         ] + messages
-    messages = [
-        {
-            "role": messages[1]["role"],
-            "content": B_SYS + messages[0]["content"] + E_SYS + messages[1]["content"],
-        }
-    ] + messages[2:]
-
-    messages_list = [
-        f"{BOS}{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} {EOS}"
-        for prompt, answer in zip(messages[::2], messages[1::2])
+    system = B_SYS + messages[0]["content"] + E_SYS
+    messages = messages[1:]
+
+    def turn(prompt: str, answer: str = None, first: bool = False):
+        # the system prompt goes in the first turn that is kept
+        prompt = (system if first else "") + prompt
+        if answer is None:
+            return [bos_id] + list(encode(f"{B_INST} {prompt.strip()} {E_INST}"))
+        return (
+            [bos_id]
+            + list(encode(f"{B_INST} {prompt.strip()} {E_INST} {answer.strip()} "))
+            + [eos_id]
+        )
+
+    turns = [
+        (prompt["content"], answer["content"])
+        for prompt, answer in zip(messages[:-1:2], messages[1::2])
     ]
-    messages_list.append(f"{BOS}{B_INST} {(messages[-1]['content']).strip()} {E_INST}")
+    last = turn(messages[-1]["content"], first=len(turns) == 0)
+    history = [turn(prompt, answer) for prompt, answer in turns[1:]]
+
+    min_token_reply = min(min_token_reply, max_seq_len // 2)
+    budget = max_seq_len - max_new_tokens
+
+    # drop the oldest turns until the prompt fits, the last message is kept
+    history_lengths = [len(ids) for ids in history]
+    start = 0
+    while start < len(turns):
+        first = turn(*turns[start], first=True)
+        if len(first) + sum(history_lengths[start:]) + len(last) <= budget:
+            break
+        start += 1
+
+    if start < len(turns):
+        ids = first + [id for ids in history[start:] for id in ids] + last
+    else:
+        ids = turn(messages[-1]["content"], first=True)
+
+    if len(ids) > budget:
+        # the reply gives up tokens, down to min_token_reply
+        max_new_tokens = max(
+            min(max_new_tokens, min_token_reply), max_seq_len - len(ids)
+        )
+        budget = max_seq_len - max_new_tokens
+    if len(ids) > budget:
+        # last resort, keep the most recent part of the prompt
+        ids = ids[:1] + ids[len(ids) - budget + 1 :]
 
-    return "".join(messages_list)
+    return ids, max_new_tokens
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from collections import deque
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class QueueTimeoutError(Exception):
+    pass
+
+
+class GenerationSlot:
+    # exclusive use of the model, it can be released more than once
+    def __init__(self, queue, position: int, waited: float):
+        self.queue = queue
+        # requests ahead of this one when it arrived and seconds spent waiting
+        self.position = position
+        self.waited = waited
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.queue.release()
+
+
+class GenerationQueue:
+    # first come first served access to the model. The model is handed over
+    # directly to the oldest waiting request, so no request can overtake it
+    def __init__(self, max_size: int, timeout: float):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.waiters = deque()
+        self.busy = False
+
+        self.served = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait = 0.0
+
+    async def acquire(self):
+        start = time.monotonic()
+        position = len(self.waiters) + (1 if self.busy else 0)
+
+        if not self.busy:
+            self.busy = True
+        else:
+            if len(self.waiters) >= self.max_size:
+                self.rejected += 1
+                raise QueueFullError()
+
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, self.timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                if waiter.done() and not waiter.cancelled():
+                    # the model was handed over while giving up, pass it on
+                    self.release()
+                elif waiter in self.waiters:
+                    self.waiters.remove(waiter)
+
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timed_out += 1
+                    raise QueueTimeoutError()
+                raise
+
+        waited = time.monotonic() - start
+        self.served += 1
+        self.total_wait += waited
+        return GenerationSlot(self, position, waited)
+
+    def release(self):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.busy = False
+
+    def stats(self):
+        return {
+            "busy": self.busy,
+            "depth": len(self.waiters),
+            "max_size": self.max_size,
+            "timeout": self.timeout,
+            "served": self.served,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "avg_wait_ms": 1000 * self.total_wait / self.served if self.served else 0,
+        }